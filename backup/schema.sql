@@ -6,11 +6,13 @@ use app_test;
 
 grant select, insert, update, delete on app_test.* to 'www-data'@'localhost' identified by 'www-data';
 
-create table users (
-    `id` varchar(50) not null,
+-- 以下由 python www/schema.py 生成，修改模型后重新生成，已有的库用 python www/schema.py diff 迁移
+
+create table `users` (
+    `id` bigint not null,
     `email` varchar(50) not null,
     `passwd` varchar(50) not null,
-    `admin` bool not null,
+    `admin` boolean not null,
     `name` varchar(50) not null,
     `image` varchar(500) not null,
     `created_at` real not null,
@@ -19,27 +21,38 @@ create table users (
     primary key (`id`)
 ) engine=innodb default charset=utf8;
 
-create table blogs (
-    `id` varchar(50) not null,
-    `user_id` varchar(50) not null,
+create table `blogs` (
+    `id` bigint not null,
+    `user_id` bigint not null,
     `user_name` varchar(50) not null,
     `user_image` varchar(500) not null,
-    `name` varchar(50) not null,
+    `name` varchar(100) not null,
     `summary` varchar(200) not null,
     `content` mediumtext not null,
     `created_at` real not null,
+    key `idx_user_id` (`user_id`),
     key `idx_created_at` (`created_at`),
     primary key (`id`)
 ) engine=innodb default charset=utf8;
 
-create table comments (
-    `id` varchar(50) not null,
-    `blog_id` varchar(50) not null,
-    `user_id` varchar(50) not null,
+create table `comments` (
+    `id` bigint not null,
+    `blog_id` bigint not null,
+    `user_id` bigint not null,
     `user_name` varchar(50) not null,
     `user_image` varchar(500) not null,
     `content` mediumtext not null,
     `created_at` real not null,
     key `idx_created_at` (`created_at`),
+    key `idx_blog_id_created_at` (`blog_id`, `created_at`),
     primary key (`id`)
-) engine=innodb default charset=utf8;
\ No newline at end of file
+) engine=innodb default charset=utf8;
+
+create table `counters` (
+    `table_name` varchar(50) not null,
+    `group_by` varchar(100) not null,
+    `group_key` varchar(500) not null,
+    `n` bigint not null,
+    `updated_at` real not null,
+    primary key (`table_name`, `group_by`, `group_key`)
+) engine=innodb default charset=utf8;
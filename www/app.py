@@ -1,16 +1,45 @@
 import logging;
-import asyncio, os, json, time
+import asyncio, time, queue, random, hashlib, types, signal
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
 
 from config import configs
 
 from aiohttp import web
-from jinja2 import Environment, FileSystemLoader
 
 import orm
-from coroweb import add_routes, add_static
+import serializers
+from apis import APIError
+from coroweb import add_routes, add_static, add_metrics
+from metrics import REGISTRY, RequestTimer, current_timer, add_phase
+from cache import TaggedCache
+from assets import COMPRESSIBLE, available_encodings, compress, negotiate
+from templating import TEMPLATE_PATH, create_environment, precompile
+from search import init_search, close_search
 
-logging.basicConfig(level=logging.INFO)
+
+def init_logging(level='INFO', queue_handler=True):
+    '''
+    Configure the root logger. With queue_handler, records are handed to a QueueListener thread
+    so the event loop never blocks on log I/O. logger_factory logs the configs.log.sample fraction of requests.
+    '''
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    root = logging.getLogger()
+    root.setLevel(level)
+    listener = None
+    if queue_handler:
+        q = queue.SimpleQueue()
+        root.addHandler(QueueHandler(q))
+        listener = QueueListener(q, handler)
+        listener.start()
+    else:
+        root.addHandler(handler)
+    return listener
+
+
+log_listener = init_logging(configs.log.level, configs.log.queue)
 
 
 def init_jinja2(app, **kw):
@@ -25,43 +54,261 @@ def init_jinja2(app, **kw):
     )
     path = kw.get('path', None)
     if path is None:
-        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+        path = TEMPLATE_PATH
     logging.info('set jinja2 template path: {!s}'.format(path))
-    env = Environment(loader=FileSystemLoader(path), **options)
+    production = kw.get('production', False)
+    env = create_environment(path, production, kw.get('bytecode_cache', None), kw.get('fragment_cache_size', 1000),
+                             **options)
     filters = kw.get('filters', None)
     if filters is not None:
         for name, f in filters.items():
             env.filters[name] = f
+    if production:
+        precompile(env)
     app['__templating__'] = env
 
 
 async def logger_factory(app, handler):
+    sample = configs.log.sample
+
     async def logger(request):
-        logging.info('Request: {!s} {!s}'.format(request.method, request.path))
+        if sample >= 1 or random.random() < sample:
+            logging.info('Request: %s %s', request.method, request.path)
         return (await handler(request))
 
     return logger
 
 
+def route_of(request):
+    ' route template of requests not served by a RequestHandler, e.g. static files. '
+    try:
+        return request.match_info.route.resource.canonical
+    except AttributeError:
+        return 'unmatched'
+
+
+async def timing_factory(app, handler):
+    async def timing(request):
+        timer = RequestTimer()
+        token = current_timer.set(timer)
+        start = time.perf_counter()
+        try:
+            return (await handler(request))
+        finally:
+            current_timer.reset(token)
+            timer.record(request.method, timer.route or route_of(request), time.perf_counter() - start)
+
+    return timing
+
+
+async def batch_factory(app, handler):
+    ' batch the Model.find() calls of each request, see orm.batching(). '
+
+    async def batch(request):
+        with orm.batching():
+            return (await handler(request))
+
+    return batch
+
+
 async def data_factory(app, handler):
     async def parse_data(request):
         if request.content_type.startswith('application/json'):
             request.__data__ = await request.json()
-            logging.info('request json: {!s}'.format(str(request.__data__)))
+            logging.debug('request json: %s', request.__data__)
         elif request.content_type.startswith('application/x-www-form-urlencoded'):
             request.__data__ = await  request.post()
-            logging.info('request form: {!s}'.format(request.__data__))
+            logging.debug('request form: %s', request.__data__)
         return (await handler(request))
 
     return parse_data
 
 
+compressed_bytes = REGISTRY.counter('http_compressed_bytes_total', 'Response bytes before and after compression.')
+
+
+def init_compression(app):
+    ' the thread pool of compress_body(), made once: aiohttp calls middleware factories for every request. '
+    app['__compress_executor__'] = ThreadPoolExecutor(configs.compression.threads, thread_name_prefix='compress')
+    app['__compress_encodings__'] = available_encodings(configs.compression.encodings)
+
+
+async def compress_body(app, body, encoding):
+    '''
+    body compressed with encoding at the configured level. Bodies from thread_min_size up are
+    compressed in a thread pool (zlib and brotli release the GIL) so the event loop keeps serving.
+    '''
+    options = configs.compression
+    level = options.brotli_level if encoding == 'br' else options.level
+    if len(body) >= options.thread_min_size:
+        data = await asyncio.get_event_loop().run_in_executor(app['__compress_executor__'], compress, body,
+                                                              encoding, level)
+    else:
+        data = compress(body, encoding, level)
+    compressed_bytes.inc(len(body), stage='in', encoding=encoding)
+    compressed_bytes.inc(len(data), stage='out', encoding=encoding)
+    return data
+
+
+async def compress_factory(app, handler):
+    '''
+    Compress response bodies with the best encoding the client accepts, see compress_body().
+    Bodies under min_size and content that is not text are sent as they are.
+    Streamed responses compress themselves, see stream_json().
+    '''
+    options = configs.compression
+    encodings = app['__compress_encodings__']
+    # StreamResponse.enable_compression()只支持gzip和deflate
+    stream_encodings = [e for e in encodings if e != 'br']
+
+    async def compression(request):
+        header = request.headers.get('Accept-Encoding', '')
+        request['compress'] = negotiate(header, stream_encodings)
+        resp = await handler(request)
+        if not isinstance(resp, web.Response) or not isinstance(resp.body, bytes) or resp.status != 200 \
+                or 'Content-Encoding' in resp.headers or not (resp.content_type or '').startswith(COMPRESSIBLE):
+            return resp
+        body = resp.body
+        if len(body) < options.min_size:
+            return resp
+        encoding = negotiate(header, encodings)
+        resp.headers['Vary'] = 'Accept-Encoding'
+        if encoding is None:
+            return resp
+        resp.body = await compress_body(app, body, encoding)
+        resp.headers['Content-Encoding'] = encoding
+        etag = resp.headers.get('ETag')
+        if etag and etag.startswith('"'):
+            # 压缩后是另一个表示，强ETag按编码区分，同Asset.etag()
+            resp.headers['ETag'] = etag_variant(etag, encoding)
+        return resp
+
+    return compression
+
+
+def etag_variant(etag, encoding):
+    ' the strong etag of the representation compressed with encoding. '
+    return '{}-{}"'.format(etag[:-1], encoding)
+
+
+def etag_matches(request, etag):
+    ' the tag of If-None-Match naming etag or one of its compressed variants, None if there is none. '
+    header = request.headers.get('If-None-Match')
+    if not header:
+        return None
+    if header.strip() == '*':
+        return etag
+    variants = {etag} | {etag_variant(etag, e) for e in configs.compression.encodings}
+    for tag in header.split(','):
+        if tag.strip() in variants:
+            return tag.strip()
+    return None
+
+
+async def cached_response(app, request, entry, max_age):
+    '''
+    The response of a page cache entry, compressed like compress_factory does. Each encoding of the
+    body is compressed once and kept in the entry.
+    '''
+    headers = {'ETag': entry['etag'],
+               'Cache-Control': 'public, max-age={}'.format(max_age) if max_age else 'no-cache'}
+    body = entry['body']
+    encoding = None
+    if len(body) >= configs.compression.min_size and (entry['content_type'] or '').startswith(COMPRESSIBLE):
+        headers['Vary'] = 'Accept-Encoding'
+        encoding = negotiate(request.headers.get('Accept-Encoding', ''), app['__compress_encodings__'])
+    matched = etag_matches(request, entry['etag'])
+    if matched:
+        # 304带上客户端缓存的那个表示的ETag
+        headers['ETag'] = matched
+        return web.Response(status=304, headers=headers)
+    if encoding is not None:
+        if encoding not in entry['encoded']:
+            entry['encoded'][encoding] = await compress_body(app, body, encoding)
+        body = entry['encoded'][encoding]
+        headers['Content-Encoding'] = encoding
+        headers['ETag'] = etag_variant(entry['etag'], encoding)
+    resp = web.Response(body=body, headers=headers)
+    resp.content_type = entry['content_type']
+    resp.charset = entry['charset']
+    return resp
+
+
+def init_page_cache(app):
+    ' the page cache of cache_factory, made once: aiohttp calls middleware factories for every request. '
+    pages = TaggedCache(size=configs.page_cache.size, max_bytes=configs.page_cache.max_bytes)
+    orm.write_listeners.append(pages.invalidate_tag)
+    app['__page_cache__'] = pages
+
+
+async def cache_factory(app, handler):
+    '''
+    Serve routes marked with @cached() from memory. Entries are tagged with the tables read while
+    rendering and dropped by orm writes to them; If-None-Match is answered with 304. A page is not
+    kept when a table it read was written while it rendered, see orm.WriteClock.
+    '''
+    pages = app['__page_cache__']
+
+    async def cache(request):
+        policy = getattr(request.match_info.handler, 'cache', None)
+        if policy is None or request.method != 'GET':
+            return (await handler(request))
+        key = request.path_qs
+        entry = pages.get(key)
+        if entry is None:
+            mark = orm.write_clock.mark()
+            with orm.reading() as tables:
+                resp = await handler(request)
+            if not isinstance(resp, web.Response) or resp.status != 200 or not isinstance(resp.body, bytes):
+                return resp
+            body = bytes(resp.body)
+            entry = dict(body=body, etag='"{}"'.format(hashlib.sha1(body).hexdigest()),
+                         content_type=resp.content_type, charset=resp.charset, encoded={})
+            if orm.write_clock.fresh(mark, tables):
+                pages.put(key, entry, tables, policy['ttl'])
+        return (await cached_response(app, request, entry, policy['max_age']))
+
+    return cache
+
+
+async def stream_json(request, items):
+    '''
+    Stream an iterator or async iterator as a JSON array, or as NDJSON when the client accepts
+    application/x-ndjson.
+    '''
+    ndjson = 'application/x-ndjson' in request.headers.get('Accept', '')
+    resp = web.StreamResponse()
+    resp.content_type = 'application/x-ndjson' if ndjson else 'application/json'
+    resp.charset = 'utf-8'
+    encoding = request.get('compress')
+    if encoding is not None:
+        resp.enable_compression(web.ContentCoding(encoding))
+    await resp.prepare(request)
+    async for chunk in serializers.iter_json(items, ndjson):
+        await resp.write(chunk)
+    await resp.write_eof()
+    return resp
+
+
 async def response_factory(app, handler):
     async def response(request):
-        logging.info('Response handler...')
+        logging.debug('Response handler...')
         r = await handler(request)
+        start = time.perf_counter()
+        try:
+            return (await render(request, r))
+        finally:
+            add_phase('render', time.perf_counter() - start)
+
+    async def render(request, r):
         if isinstance(r, web.StreamResponse):
             return r
+        if hasattr(r, '__aiter__') or isinstance(r, types.GeneratorType):
+            return (await stream_json(request, r))
+        if isinstance(r, APIError):
+            resp = web.Response(body=serializers.dumps(r))
+            resp.content_type = 'application/json;charset=utf-8'
+            return resp
         if isinstance(r, bytes):
             resp = web.Response(body=r)
             resp.content_type = 'application/octet-stream'
@@ -75,8 +322,7 @@ async def response_factory(app, handler):
         if isinstance(r, dict):
             template = r.get('__template__')
             if template is None:
-                resp = web.Response(
-                    body=json.dumps(r, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8'))
+                resp = web.Response(body=serializers.dumps(r))
                 resp.content_type = 'application/json;charset=utf-8'
                 return resp
             else:
@@ -97,20 +343,6 @@ async def response_factory(app, handler):
     return response
 
 
-def datetime_filter(t):
-    delta = int(time.time() - t)
-    if delta < 60:
-        return u'1 minute ago'
-    if delta < 3600:
-        return u'{!s} minutes ago'.format(delta // 60)
-    if delta < 86400:
-        return u'{!s} hours ago'.format(delta // 3600)
-    if delta < 604800:
-        return u'{!s} days ago'.format(delta // 86400)
-    dt = datetime.fromtimestamp(t)
-    return u'{!s}.{!s}.{!s}'.format(dt.year, dt.month, dt.day)
-
-
 # def index(request):
 #     headers = {"content-type": "text/html"}
 #     if request.match_info:
@@ -119,29 +351,70 @@ def datetime_filter(t):
 #         text = '<h1>Hello world!</h1>'
 #     return web.Response(body=text.encode('utf-8'), headers=headers)
 
-#
-# async def init(loop):
-#     app = web.Application(loop=loop)
-#     # app.router.add_route('GET', '/', index)
-#     app.router.add_route('GET', '/{name}', index)
-#     srv = await loop.create_server(app.make_handler(), '127.0.0.1', 8090)
-#     logging.info(str(datetime.now()) + 'server started at http://127.0.0.1:8090....')
-#     return srv
-async def init(loop):
+
+async def init(loop, sock=None, maxsize=None):
+    ' create the app and serve it on sock, or on configs.server host and port; returns (app, handler, srv). '
+    maxsize = maxsize or configs.db.maxsize
     # await orm.create_pool(loop=loop, host='127.0.0.1', port=3306, user='www-data', password='www-data', db='app_test')
     await orm.create_pool(loop=loop, host=configs.db.host, port=configs.db.port, user=configs.db.user,
-                          password=configs.db.password, db=configs.db.database)
-    app = web.Application(loop=loop, middlewares=[logger_factory, response_factory])
-    init_jinja2(app, filters=dict(datetime=datetime_filter))
+                          password=configs.db.password, db=configs.db.database, replicas=configs.db.replicas,
+                          sticky=configs.db.sticky, replica_lag=configs.db.replica_lag,
+                          slow_query=configs.db.slow_query,
+                          maxsize=maxsize, minsize=min(configs.db.minsize, maxsize),
+                          warm_size=min(configs.db.warm_size, maxsize), validate_idle=configs.db.validate_idle,
+                          max_lifetime=configs.db.max_lifetime, max_idle=configs.db.max_idle,
+                          recycle_interval=configs.db.recycle_interval, coalesce=configs.db.coalesce,
+                          explain=configs.db.explain)
+    serializers.use(configs.json.encoder)
+    app = web.Application(loop=loop, middlewares=[timing_factory, logger_factory, compress_factory, cache_factory,
+                                                         batch_factory, response_factory])
+    init_jinja2(app, production=configs.templates.production, bytecode_cache=configs.templates.bytecode_cache,
+                fragment_cache_size=configs.templates.fragment_cache_size)
     # app.router.add_route('GET', '/', index)
     # app.router.add_route('GET', '/{name}', index)
     add_routes(app, 'handlers')
-    add_static(app)
-    srv = await loop.create_server(app.make_handler(), '127.0.0.1', 8090)
-    logging.info(str(datetime.now()) + 'server started at http://127.0.0.1:8090....')
-    return srv
+    add_static(app, encodings=configs.static.encodings, min_size=configs.static.min_size,
+               memory_max_size=configs.static.memory_max_size, memory_max_bytes=configs.static.memory_max_bytes)
+    add_metrics(app)
+    init_compression(app)
+    init_page_cache(app)
+    if configs.search.enabled:
+        await init_search(app, configs.search.path, configs.search.save_interval, configs.search.sync_interval)
+    handler = app.make_handler()
+    if sock is None:
+        srv = await loop.create_server(handler, configs.server.host, configs.server.port)
+    else:
+        srv = await loop.create_server(handler, sock=sock)
+    logging.info(str(datetime.now()) + 'server started at http://{}:{}....'.format(configs.server.host,
+                                                                                  configs.server.port))
+    return app, handler, srv
+
+
+async def shutdown(app, handler, srv, timeout=30):
+    '''
+    Stop accepting connections, let in-flight requests finish within timeout, then close the pools.
+    '''
+    srv.close()
+    await srv.wait_closed()
+    await app.shutdown()
+    await handler.shutdown(timeout)
+    await app.cleanup()
+    if '__search__' in app:
+        await close_search(app)
+    app['__compress_executor__'].shutdown(wait=False)
+    await orm.destroy_pool()
 
 
-loop = asyncio.get_event_loop()
-loop.run_until_complete(init(loop))
-loop.run_forever()
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    server = loop.run_until_complete(init(loop))
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, loop.stop)
+    try:
+        loop.run_forever()
+    finally:
+        logging.info('shutting down....')
+        loop.run_until_complete(shutdown(*server, timeout=configs.server.shutdown_timeout))
+        if log_listener is not None:
+            log_listener.stop()
+        loop.close()
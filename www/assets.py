@@ -0,0 +1,229 @@
+'''
+    Static assets: precompressed variants, content-hashed urls and an in-memory cache of small files.
+'''
+
+import os, gzip, zlib, hashlib, functools, logging, mimetypes
+from email.utils import formatdate, parsedate_to_datetime
+
+from aiohttp import web
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+STATIC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+
+# 已压缩的格式再压缩没有收益
+COMPRESSIBLE = ('text/', 'application/javascript', 'application/json', 'application/xml', 'image/svg+xml')
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+
+def available_encodings(encodings):
+    ' the encodings that can be produced, in the given order of preference. '
+    return [e for e in encodings if e in ('gzip', 'deflate') or (e == 'br' and brotli is not None)]
+
+
+def compress(data, encoding, level):
+    ' data encoded for a Content-Encoding, level is the brotli quality for br. '
+    if encoding == 'br':
+        return brotli.compress(data, quality=level)
+    if encoding == 'gzip':
+        return gzip.compress(data, level, mtime=0)
+    return zlib.compress(data, level)
+
+
+def compressors(encodings):
+    ' {encoding: compress(data)} at maximum level for the configured encodings that are available. '
+    return {e: functools.partial(compress, encoding=e, level=11 if e == 'br' else 9)
+            for e in available_encodings(encodings) if e != 'deflate'}
+
+
+def accepted_encodings(header):
+    ' encodings accepted by an Accept-Encoding header, without those with q=0. '
+    accepted = set()
+    for item in header.split(','):
+        name, _, params = item.strip().partition(';')
+        params = params.replace(' ', '')
+        if params.startswith('q='):
+            try:
+                q = float(params[2:] or 0)
+            except ValueError:
+                # 格式不对的q值当作不接受
+                continue
+            if q == 0:
+                continue
+        accepted.add(name.strip().lower())
+    return accepted
+
+
+def negotiate(header, encodings):
+    ' the first of encodings accepted by an Accept-Encoding header, or None. '
+    if not header:
+        return None
+    accepted = accepted_encodings(header)
+    for encoding in encodings:
+        if encoding in accepted:
+            return encoding
+    return None
+
+
+class Asset(object):
+    '''
+    One static file: its content hash, modification time and encoded variants on disk,
+    plus their bodies when the file is small enough to keep in memory.
+    '''
+
+    def __init__(self, name, path, data, mtime):
+        self.name = name
+        self.path = path
+        self.mtime = mtime
+        self.digest = hashlib.md5(data).hexdigest()
+        base, ext = os.path.splitext(name)
+        self.hashed_name = '{}.{}{}'.format(base, self.digest[:10], ext)
+        self.content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        self.last_modified = formatdate(mtime, usegmt=True)
+        # 编码 => (磁盘路径, 大小)，None为原文件
+        self.variants = {None: (path, len(data))}
+        self.bodies = {}
+
+    def etag(self, encoding):
+        return '"{}{}"'.format(self.digest, '-' + encoding if encoding else '')
+
+    def compressible(self):
+        return self.content_type.startswith(COMPRESSIBLE)
+
+
+class AssetFileResponse(web.FileResponse):
+    '''
+    A FileResponse of an asset variant. FileResponse sets ETag and Last-Modified from the variant
+    file while preparing, restore_validators() puts back those of the asset before they are sent.
+    '''
+
+    def __init__(self, path, headers):
+        super().__init__(path, headers=headers)
+        self.validators = {k: headers[k] for k in ('ETag', 'Last-Modified')}
+
+
+async def restore_validators(request, response):
+    ' on_response_prepare signal handler, see AssetFileResponse. '
+    if isinstance(response, AssetFileResponse):
+        response.headers.update(response.validators)
+
+
+class StaticFiles(object):
+    '''
+    Serve the files under root at prefix. Compressible files get .gz (and .br with the brotli
+    package) variants built next to them, the best one accepted by the client is sent; files up to
+    memory_max_size are answered from memory, others by sendfile through web.FileResponse.
+    Requests for hashed names from url() are cacheable forever, plain names are revalidated.
+    '''
+
+    def __init__(self, root=STATIC_PATH, prefix='/static/', encodings=('br', 'gzip'), min_size=1024,
+                 memory_max_size=64 * 1024, memory_max_bytes=32 * 1024 * 1024):
+        self.root = root
+        self.prefix = prefix
+        self.compressors = compressors(encodings)
+        self.min_size = min_size
+        self.memory_max_size = memory_max_size
+        self.memory_max_bytes = memory_max_bytes
+        self.memory_bytes = 0
+        self.assets = {}
+        self.hashed = {}
+
+    def scan(self):
+        ' load every file, building variants that are missing or older than their source. '
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for filename in sorted(filenames):
+                if filename.startswith('.') or filename.endswith(('.gz', '.br', '.tmp')):
+                    continue
+                path = os.path.join(dirpath, filename)
+                name = os.path.relpath(path, self.root).replace(os.sep, '/')
+                self.add(name, path)
+        logging.info('static: {} files, {} bytes in memory'.format(len(self.assets), self.memory_bytes))
+        return self
+
+    def add(self, name, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        asset = Asset(name, path, data, os.path.getmtime(path))
+        if asset.compressible() and len(data) >= self.min_size:
+            for encoding, compress in self.compressors.items():
+                variant = '{}.{}'.format(path, 'gz' if encoding == 'gzip' else encoding)
+                if not os.path.exists(variant) or os.path.getmtime(variant) < asset.mtime:
+                    # 先写临时文件再改名，并发启动的进程不会读到写了一半的文件
+                    tmp = '{}.{}.tmp'.format(variant, os.getpid())
+                    with open(tmp, 'wb') as f:
+                        f.write(compress(data))
+                    os.replace(tmp, variant)
+                size = os.path.getsize(variant)
+                # 压缩后不更小就不用
+                if size < len(data):
+                    asset.variants[encoding] = (variant, size)
+        if len(data) <= self.memory_max_size:
+            for encoding, (variant, size) in asset.variants.items():
+                if self.memory_bytes + size > self.memory_max_bytes:
+                    break
+                with open(variant, 'rb') as f:
+                    asset.bodies[encoding] = f.read()
+                self.memory_bytes += size
+        self.assets[name] = asset
+        self.hashed[asset.hashed_name] = asset
+        return asset
+
+    def url(self, name):
+        ' content-hashed url of name, the plain url for files that are not found. '
+        asset = self.assets.get(name.lstrip('/'))
+        return self.prefix + (asset.hashed_name if asset is not None else name.lstrip('/'))
+
+    def choose(self, asset, header):
+        if len(asset.variants) == 1:
+            return None
+        return negotiate(header, [e for e in ('br', 'gzip') if e in asset.variants])
+
+    async def handle(self, request):
+        filename = request.match_info['filename']
+        asset = self.hashed.get(filename)
+        immutable = asset is not None
+        if asset is None:
+            asset = self.assets.get(filename)
+        if asset is None:
+            raise web.HTTPNotFound()
+        encoding = self.choose(asset, request.headers.get('Accept-Encoding', ''))
+        etag = asset.etag(encoding)
+        headers = {'ETag': etag, 'Last-Modified': asset.last_modified,
+                   'Cache-Control': IMMUTABLE if immutable else 'no-cache'}
+        if len(asset.variants) > 1:
+            headers['Vary'] = 'Accept-Encoding'
+        if not_modified(request, etag, asset.mtime):
+            return web.Response(status=304, headers=headers)
+        if encoding is not None:
+            headers['Content-Encoding'] = encoding
+        body = asset.bodies.get(encoding)
+        if body is None:
+            resp = AssetFileResponse(asset.variants[encoding][0], headers)
+        else:
+            resp = web.Response(body=body, headers=headers)
+        resp.content_type = asset.content_type
+        return resp
+
+
+def not_modified(request, etag, mtime):
+    inm = request.headers.get('If-None-Match')
+    if inm is not None:
+        return inm.strip() == '*' or etag in [t.strip() for t in inm.split(',')]
+    ims = request.headers.get('If-Modified-Since')
+    if ims is not None:
+        try:
+            return int(mtime) <= parsedate_to_datetime(ims).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+if __name__ == '__main__':
+    # 部署前预先生成压缩文件
+    from config import configs
+
+    logging.basicConfig(level=logging.INFO)
+    StaticFiles(encodings=configs.static.encodings, min_size=configs.static.min_size).scan()
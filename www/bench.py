@@ -0,0 +1,541 @@
+'''
+    Benchmarks, run as: python bench.py [name ...]
+'''
+
+import asyncio, os, sys, time, tracemalloc, io, logging, queue, random, contextlib
+from logging.handlers import QueueHandler, QueueListener
+from types import SimpleNamespace
+from urllib import parse
+
+import orm
+from config import configs
+from models import Blog, Comment, next_id
+
+
+async def create_pool(lp, **kw):
+    await orm.create_pool(lp, host=configs.db.host, port=configs.db.port, user=configs.db.user,
+                          password=configs.db.password, db=configs.db.database, **kw)
+
+
+def report(name, n, seconds, unit='rows'):
+    print('{:<32} {:>8} {} {:>8.3f}s {:>10.0f} {}/s'.format(name, n, unit, seconds, n / seconds, unit))
+
+
+async def bench_bulk(lp, n=2000):
+    ' per-row save()/remove() against save_many()/remove_many(). '
+    await create_pool(lp)
+    comments = [Comment(blog_id=next_id(), user_id=next_id(), user_name='bench', user_image='about:blank',
+                        content='bench comment {}'.format(i)) for i in range(n)]
+    start = time.time()
+    for c in comments:
+        await c.save()
+    report('save (per row)', n, time.time() - start)
+    start = time.time()
+    for c in comments:
+        await c.remove()
+    report('remove (per row)', n, time.time() - start)
+    start = time.time()
+    await Comment.save_many(comments)
+    report('save_many', n, time.time() - start)
+    start = time.time()
+    await Comment.update_many(comments)
+    report('update_many', n, time.time() - start)
+    start = time.time()
+    await Comment.remove_many(comments)
+    report('remove_many', n, time.time() - start)
+    await orm.destroy_pool()
+
+
+def legacy_findall_sql(cls, where, args, orderBy, limit):
+    ' the statement building findall() did on every call before the statement cache. '
+    sql = [cls.__select__]
+    if where:
+        sql.append('where')
+        sql.append(where)
+    if orderBy:
+        sql.append('order by')
+        sql.append(orderBy)
+    sql.append('limit')
+    sql.append('?,?')
+    args.extend(limit)
+    return ' '.join(sql).replace('?', '%s')
+
+
+def timeit(fn, n):
+    start = time.perf_counter()
+    for i in range(n):
+        fn()
+    return time.perf_counter() - start
+
+
+async def bench_sqlprep(lp, n=200000):
+    ' sql preparation of find()/findall() per call, without the database. '
+    pk = '{} where `{}`=?'
+    report('find (format + replace)', n,
+           timeit(lambda: pk.format(Blog.__select__, Blog.__primary_key__).replace('?', '%s'), n), 'calls')
+    report('find (compiled)', n, timeit(lambda: orm.compile_sql(Blog.__find__), n), 'calls')
+    report('findall (build + replace)', n,
+           timeit(lambda: legacy_findall_sql(Blog, 'user_id=?', ['u'], 'created_at desc', (0, 10)), n), 'calls')
+    report('findall (compiled)', n,
+           timeit(lambda: orm.compile_sql(orm.findall_sql(Blog, 'user_id=?', 'created_at desc', 2)), n), 'calls')
+
+
+def measure_rows(hydrate, n):
+    ' seconds to hydrate n rows and the memory they retain per row. '
+    tracemalloc.start()
+    start = time.perf_counter()
+    rows = hydrate()
+    seconds = time.perf_counter() - start
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del rows
+    return seconds, size / n
+
+
+async def bench_rows(lp, n=100000):
+    ' Model from DictCursor dicts against __row__ from tuple cursor rows, without the database. '
+    columns = [Blog.__primary_key__] + Blog.__fields__
+    values = [(str(i), 'user', 'name', 'about:blank', 'blog {}'.format(i), 'summary', 'content', time.time())
+              for i in range(n)]
+    dicts = [dict(zip(columns, v)) for v in values]
+    row = Blog.__row__
+    for name, hydrate in (('Model(**dict)', lambda: [Blog(**r) for r in dicts]),
+                          ('__row__(*tuple)', lambda: [row(*r) for r in values])):
+        seconds, per_row = measure_rows(hydrate, n)
+        report(name, n, seconds)
+        print('{:<32} {:>8.0f} bytes/row'.format('', per_row))
+
+
+def legacy_request_logs(request, kw, sqls):
+    ' the log calls of one request before lazy formatting and sampling. '
+    logging.info('Request: {!s} {!s}'.format(*request))
+    logging.info('Response handler...')
+    logging.info('call with args: {!s}'.format(str(kw)))
+    for sql in sqls:
+        logging.info('SQL: {}'.format(sql))
+        logging.info('rows returned: {}'.format(20))
+
+
+def request_logs(request, kw, sqls, sample):
+    ' the log calls of one request now, see app.logger_factory and coroweb.RequestHandler. '
+    if sample >= 1 or random.random() < sample:
+        logging.info('Request: %s %s', *request)
+    logging.debug('Response handler...')
+    logging.debug('call with args: %s', kw)
+    for sql in sqls:
+        logging.debug('SQL: %s', sql)
+        logging.debug('rows returned: %s', 20)
+
+
+async def bench_logging(lp, n=20000):
+    ' per-request logging overhead at INFO, writing to memory directly or through a queue. '
+    root = logging.getLogger()
+    root.handlers, level = [], root.level
+    root.setLevel(logging.INFO)
+    request = ('GET', '/api/blogs')
+    kw = dict(after='WzEuNSwgImFiYyJd', size='20', request='<Request GET /api/blogs >')
+    sqls = [Blog.__find__, orm.findall_sql(Blog, 'user_id=?', 'created_at desc', 2)]
+    for name, queued, fn in (('eager, direct', False, lambda: legacy_request_logs(request, kw, sqls)),
+                             ('lazy, direct', False, lambda: request_logs(request, kw, sqls, 1.0)),
+                             ('lazy 1% sampled, queue', True, lambda: request_logs(request, kw, sqls, 0.01))):
+        handler = logging.StreamHandler(io.StringIO())
+        listener = None
+        if queued:
+            q = queue.SimpleQueue()
+            listener = QueueListener(q, handler)
+            listener.start()
+            handler = QueueHandler(q)
+        root.addHandler(handler)
+        seconds = timeit(fn, n)
+        root.removeHandler(handler)
+        if listener is not None:
+            listener.stop()
+        report(name, n, seconds, 'requests')
+        print('{:<32} {:>8.2f} us/request'.format('', seconds / n * 1e6))
+    root.setLevel(level)
+
+
+class LegacyRequestHandler(object):
+    ' RequestHandler.__call__ before the compiled binder, without the logging and timing. '
+
+    def __init__(self, fn):
+        import coroweb
+        self._func = fn
+        self._has_request_arg = coroweb.has_request_arg(fn)
+        self._has_var_kw_arg = coroweb.has_var_kw_arg(fn)
+        self._has_named_kw_args = coroweb.has_named_kw_args(fn)
+        self._named_kw_args = coroweb.get_named_kw_args(fn)
+        self._required_kw_args = coroweb.get_required_kw_args(fn)
+
+    async def __call__(self, request):
+        kw = None
+        if self._has_var_kw_arg or self._has_named_kw_args or self._required_kw_args:
+            if request.method == 'GET':
+                qs = request.query_string
+                if qs:
+                    kw = dict()
+                    for k, v in parse.parse_qs(qs, True).items():
+                        kw[k] = v[0]
+        if kw is None:
+            kw = dict(**request.match_info)
+        else:
+            if not self._has_var_kw_arg and self._named_kw_args:
+                copy = dict()
+                for name in self._named_kw_args:
+                    if name in kw:
+                        copy[name] = kw[name]
+                kw = copy
+            for k, v in request.match_info.items():
+                kw[k] = v
+        if self._has_request_arg:
+            kw['request'] = request
+        if self._required_kw_args:
+            for name in self._required_kw_args:
+                if name not in kw:
+                    return None
+        return (await self._func(**kw))
+
+
+async def bench_dispatch(lp, n=50000):
+    ' argument binding per request of a GET handler, without aiohttp routing. '
+    from multidict import MultiDict
+    from coroweb import RequestHandler
+
+    async def legacy(id, *, page='1', size='20', q=None, request):
+        return int(page), int(size)
+
+    async def compiled(id, *, page: int = 1, size: int = 20, q=None, request):
+        return page, size
+
+    qs = 'page=3&size=50&q=python'
+
+    async def run(handler):
+        start = time.perf_counter()
+        for i in range(n):
+            # aiohttp parses request.query once per request, so the parse is counted for both
+            request = SimpleNamespace(method='GET', query_string=qs, query=MultiDict(parse.parse_qsl(qs, True)),
+                                      match_info={'id': '0015'}, content_type=None)
+            await handler(request)
+        return time.perf_counter() - start
+
+    for name, handler in (('parse_qs + dict copies', LegacyRequestHandler(legacy)),
+                          ('compiled binder', RequestHandler(None, compiled))):
+        seconds = await run(handler)
+        report(name, n, seconds, 'requests')
+        print('{:<32} {:>8.2f} us/request'.format('', seconds / n * 1e6))
+
+
+async def bench_templates(lp, n=5000):
+    ' cold start and per-render time of blogs.html, development against production mode. '
+    import tempfile
+    import templating
+    blogs = [Blog(id=str(i), name='blog {}'.format(i), summary='summary', created_at=time.time() - i * 600)
+             for i in range(10)]
+    with tempfile.TemporaryDirectory() as bytecode:
+        # 先填充字节码缓存，模拟另一个worker已编译过
+        templating.precompile(templating.create_environment(production=True, bytecode_cache=bytecode))
+        for name, kw in (('development', dict(auto_reload=True)),
+                         ('production', dict(production=True)),
+                         ('production, bytecode cache', dict(production=True, bytecode_cache=bytecode))):
+            start = time.perf_counter()
+            env = templating.create_environment(**kw)
+            templating.precompile(env)
+            template = env.get_template('blogs.html')
+            template.render(blogs=blogs)
+            print('{:<32} {:>8.2f} ms cold start'.format(name, (time.perf_counter() - start) * 1e3))
+            seconds = timeit(lambda: env.get_template('blogs.html').render(blogs=blogs), n)
+            report(name, n, seconds, 'renders')
+            print('{:<32} {:>8.2f} us/render'.format('', seconds / n * 1e6))
+
+
+async def bench_static(lp, n=20000):
+    ' bytes sent per asset by encoding, and in-memory responses per second, without aiohttp. '
+    from assets import StaticFiles
+    files = StaticFiles().scan()
+    print('{:<32} {:>8} {:>8} {:>8}'.format('asset', 'identity', 'gzip', 'br'))
+    for name, asset in sorted(files.assets.items()):
+        sizes = [asset.variants.get(e, (None, '-'))[1] for e in (None, 'gzip', 'br')]
+        print('{:<32} {:>8} {:>8} {:>8}'.format(name, *sizes))
+    name = files.url('css/wing.min.css')[len(files.prefix):]
+    request = SimpleNamespace(match_info={'filename': name}, headers={'Accept-Encoding': 'gzip, deflate, br'})
+    start = time.perf_counter()
+    for i in range(n):
+        await files.handle(request)
+    report('memory (wing.min.css, br)', n, time.perf_counter() - start, 'requests')
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+async def bench_compression(lp, n=200):
+    '''
+    bytes sent for a 1000 blog JSON page per encoding, and latency of small requests served while
+    large ones are compressed inline or in a thread pool, as app.compress_factory does.
+    '''
+    import json
+    from concurrent.futures import ThreadPoolExecutor
+    from assets import available_encodings, compress
+    blogs = [dict(id='{:050d}'.format(i), user_id='0015', user_name='Test', user_image='about:blank',
+                  name='blog {}'.format(i), summary='Lorem ipsum dolor sit amet ' * 4, created_at=time.time())
+             for i in range(1000)]
+    body = json.dumps(dict(items=blogs)).encode('utf-8')
+    print('{:<32} {:>8} bytes'.format('identity', len(body)))
+    for encoding in available_encodings(['br', 'gzip', 'deflate']):
+        level = 4 if encoding == 'br' else 6
+        start = time.perf_counter()
+        data = compress(body, encoding, level)
+        print('{:<32} {:>8} bytes {:>8.2f} ms'.format('{} {}'.format(encoding, level), len(data),
+                                                      (time.perf_counter() - start) * 1e3))
+    executor = ThreadPoolExecutor(2)
+
+    async def large(offload):
+        if offload:
+            await lp.run_in_executor(executor, compress, body, 'gzip', 6)
+        else:
+            compress(body, 'gzip', 6)
+
+    async def small(latencies):
+        start = time.perf_counter()
+        await asyncio.sleep(0)
+        compress(b'{"ok": true}' * 100, 'gzip', 6)
+        latencies.append(time.perf_counter() - start)
+
+    for name, offload in (('inline', False), ('thread pool', True)):
+        latencies = []
+        tasks = []
+        for i in range(n):
+            tasks.append(large(offload))
+            tasks.extend(small(latencies) for j in range(10))
+        start = time.perf_counter()
+        await asyncio.gather(*tasks)
+        seconds = time.perf_counter() - start
+        print('{:<32} p50 {:>7.2f} ms  p99 {:>7.2f} ms  total {:.2f}s'.format(
+            'small requests, ' + name, percentile(latencies, 0.5) * 1e3, percentile(latencies, 0.99) * 1e3,
+            seconds))
+    executor.shutdown()
+
+
+async def bench_json(lp, n=200):
+    ' encoding 1000 Blog rows to bytes: the old json.dumps + encode against serializers. '
+    import json
+    import serializers
+    now = time.time()
+    blogs = [Blog(id=next_id(), user_id=next_id(), user_name='Test', user_image='about:blank',
+                  name='blog {}'.format(i), summary='Lorem ipsum dolor sit amet', content='内容 ' * 200,
+                  created_at=now) for i in range(1000)]
+    page = dict(items=blogs, next='WzEuNSwgImFiYyJd', previous=None)
+    report('json.dumps + encode', n,
+           timeit(lambda: json.dumps(page, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8'), n),
+           'pages')
+    for name, fn in sorted(serializers.ENCODERS.items()):
+        report('serializers ' + name, n, timeit(lambda: fn(page), n), 'pages')
+
+    async def stream():
+        async for chunk in serializers.iter_json(blogs):
+            pass
+
+    start = time.perf_counter()
+    for i in range(n):
+        await stream()
+    report('serializers.iter_json', n, time.perf_counter() - start, 'pages')
+
+
+async def bench_warmup(lp, burst=10):
+    ' latency of the first burst of concurrent queries after startup, with cold and warmed pools. '
+    for warm_size in (0, burst):
+        start = time.perf_counter()
+        await create_pool(lp, maxsize=burst, warm_size=warm_size)
+        started = time.perf_counter() - start
+        latencies = []
+
+        async def query():
+            begin = time.perf_counter()
+            await orm.select('select 1', ())
+            latencies.append(time.perf_counter() - begin)
+
+        await asyncio.gather(*[query() for i in range(burst)])
+        await orm.destroy_pool()
+        print('{:<32} startup {:>7.2f} ms  first burst max {:>7.2f} ms'.format(
+            'warm_size={}'.format(warm_size), started * 1e3, max(latencies) * 1e3))
+
+
+class StandInPool(object):
+    ' a pool of size connections answering every query after latency seconds, counting checkouts. '
+
+    def __init__(self, size=10, latency=0.005):
+        self.slots = asyncio.Semaphore(size)
+        self.latency = latency
+        self.checkouts = 0
+
+    @contextlib.asynccontextmanager
+    async def get(self):
+        async with self.slots:
+            self.checkouts += 1
+            yield self
+
+    def cursor(self, cls):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+    async def execute(self, sql, args):
+        self.args = args
+        await asyncio.sleep(self.latency)
+
+    async def fetchall(self):
+        return [dict(id=a, name='row {}'.format(a)) for a in self.args or ['0']]
+
+    async def fetchmany(self, size):
+        return (await self.fetchall())
+
+
+async def bench_coalesce(lp, n=500):
+    ' n concurrent identical front page queries on a 10 connection stand-in pool, without the database. '
+    for enabled in (False, True):
+        pool = StandInPool()
+        orm.use_pools(pool)
+        orm.coalescing(enabled)
+        start = time.perf_counter()
+        await asyncio.gather(*[Comment.findall('blog_id=?', ['0'], orderBy='created_at desc', limit=20)
+                               for i in range(n)])
+        seconds = time.perf_counter() - start
+        print('{:<32} {:>8} checkouts {:>8.3f}s'.format('coalesce ' + ('on' if enabled else 'off'),
+                                                        pool.checkouts, seconds))
+    orm.coalescing(False)
+
+
+async def bench_loader(lp, n=100):
+    ' a page resolving the authors of n blogs on a 10 connection stand-in pool, without the database. '
+    from models import User
+    ids = ['{:050d}'.format(i % (n // 2)) for i in range(n)]
+
+    async def page(resolve):
+        if User.__entity_cache__ is not None:
+            User.__entity_cache__.clear()
+        pool = StandInPool()
+        orm.use_pools(pool)
+        start = time.perf_counter()
+        await resolve()
+        return pool.checkouts, time.perf_counter() - start
+
+    async def sequential():
+        return [await User.find(pk) for pk in ids]
+
+    async def concurrent():
+        return (await asyncio.gather(*[User.find(pk) for pk in ids]))
+
+    async def batched():
+        with orm.batching():
+            return (await asyncio.gather(*[User.find(pk) for pk in ids]))
+
+    for name, resolve in (('find() one by one', sequential), ('find() gathered', concurrent),
+                          ('find_many()', lambda: User.find_many(ids)), ('find() gathered, batching', batched)):
+        checkouts, seconds = await page(resolve)
+        print('{:<32} {:>8} queries {:>8.2f} ms'.format(name, checkouts, seconds * 1e3))
+
+
+async def bench_search(lp, n=5000, queries=500):
+    ' indexing throughput, save and load time, and BM25 query latency on synthetic blogs. '
+    import tempfile
+    from search import SearchIndex
+    rnd = random.Random(0)
+    # 汉字和英文词都按Zipf分布取，接近真实文本的词频
+    chars = [chr(c) for c in range(0x4e00, 0x4e00 + 3000)]
+    words = ['python', 'asyncio', 'aiohttp', 'mysql', 'jinja2', 'orm', 'index', 'cache', 'pool', 'query']
+    weights = [1 / (i + 1) for i in range(len(chars))]
+
+    def text(size):
+        tokens = rnd.choices(chars, weights, k=size)
+        for i in range(0, size, 12):
+            tokens[i] = ' {} '.format(rnd.choice(words))
+        return ''.join(tokens)
+
+    docs = [(str(i), dict(name=text(10), summary=text(60), content=text(600))) for i in range(n)]
+    fields = dict(name=3, summary=2, content=1)
+    terms = [text(4) for i in range(queries)]
+    with tempfile.TemporaryDirectory() as tmp:
+        index = SearchIndex(tmp + '/search.idx')
+        start = time.perf_counter()
+        for pk, texts in docs:
+            index.add('blogs', pk, texts, fields)
+        report('index', n, time.perf_counter() - start, 'docs')
+        for name in ('memory', 'segment'):
+            if name == 'segment':
+                start = time.perf_counter()
+                index.save()
+                print('{:<32} {:>8.0f} ms, {} bytes'.format('save', (time.perf_counter() - start) * 1e3,
+                                                         os.path.getsize(index.path)))
+                start = time.perf_counter()
+                index = SearchIndex(index.path)
+                print('{:<32} {:>8.0f} ms'.format('load', (time.perf_counter() - start) * 1e3))
+            latencies = []
+            for q in terms:
+                start = time.perf_counter()
+                index.search(q)
+                latencies.append(time.perf_counter() - start)
+            print('{:<32} p50 {:>7.2f} ms  p99 {:>7.2f} ms'.format('query, ' + name, percentile(latencies, 0.5) * 1e3,
+                                                                  percentile(latencies, 0.99) * 1e3))
+        index.close()
+
+
+async def bench_ids(lp, n=200000, batch=1000):
+    '''
+    id generation, then inserts into a comments-like table with an index on blog_id for each id kind.
+    sqlite stands in for the database: a without rowid table is clustered on its primary key like innodb,
+    and secondary index entries carry the primary key.
+    '''
+    import sqlite3, tempfile
+    import ids
+    rnd = random.Random(0)
+    for kind, (factory, ddl, parse) in ids.KINDS.items():
+        make = factory(1)
+        start = time.perf_counter()
+        keys = [make() for i in range(n)]
+        report('next_id, ' + kind, n, time.perf_counter() - start, 'ids')
+        blogs = [make() for i in range(1000)]
+        with tempfile.TemporaryDirectory() as tmp:
+            db = sqlite3.connect(os.path.join(tmp, 'ids.db'))
+            db.execute('create table comments (id {} primary key, blog_id {} not null, content text not null, '
+                       'created_at real not null) without rowid'.format(ddl, ddl))
+            db.execute('create index idx_blog_id on comments (blog_id)')
+            start = time.perf_counter()
+            for i in range(0, n, batch):
+                db.executemany('insert into comments values (?, ?, ?, ?)',
+                               [(k, rnd.choice(blogs), 'comment', time.time()) for k in keys[i:i + batch]])
+                db.commit()
+            report('insert, ' + kind, n, time.perf_counter() - start)
+            sizes = dict(db.execute('select name, sum(pgsize) from dbstat group by name'))
+            print('{:<32} table {:>6.1f} MB, index on blog_id {:>6.1f} MB'.format(
+                'size, ' + kind, sizes['comments'] / 2 ** 20, sizes['idx_blog_id'] / 2 ** 20))
+            db.close()
+
+
+BENCHMARKS = {
+    'bulk': bench_bulk,
+    'coalesce': bench_coalesce,
+    'compression': bench_compression,
+    'dispatch': bench_dispatch,
+    'ids': bench_ids,
+    'json': bench_json,
+    'loader': bench_loader,
+    'logging': bench_logging,
+    'rows': bench_rows,
+    'search': bench_search,
+    'sqlprep': bench_sqlprep,
+    'static': bench_static,
+    'templates': bench_templates,
+    'warmup': bench_warmup,
+}
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    for name in sys.argv[1:] or sorted(BENCHMARKS):
+        print('== {}'.format(name))
+        loop.run_until_complete(BENCHMARKS[name](loop))
+    loop.close()
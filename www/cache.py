@@ -0,0 +1,111 @@
+'''
+    In-process caches.
+'''
+
+import sys, time
+from collections import OrderedDict
+
+
+def sizeof(value):
+    ' approximate memory size of a cached row dict. '
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for k, v in value.items():
+            size += sys.getsizeof(k) + sys.getsizeof(v)
+    return size
+
+
+class LRUCache(object):
+    '''
+    Bounded LRU cache with per-entry ttl, limited by entry count and by approximate bytes.
+    '''
+
+    def __init__(self, ttl=60, size=10000, max_bytes=None, on_drop=None):
+        self.ttl = ttl
+        self.size = size
+        self.max_bytes = max_bytes
+        self.on_drop = on_drop
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        value, expires, nbytes = entry
+        if expires < time.monotonic():
+            self._drop(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value, ttl=None):
+        if key in self._entries:
+            self._drop(key)
+        nbytes = sizeof(value)
+        self._entries[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl), nbytes)
+        self.bytes += nbytes
+        while self._entries and (len(self._entries) > self.size or (
+                self.max_bytes is not None and self.bytes > self.max_bytes)):
+            self._drop(next(iter(self._entries)))
+            self.evictions += 1
+
+    def invalidate(self, key):
+        if key in self._entries:
+            self._drop(key)
+
+    def clear(self):
+        for key in list(self._entries):
+            self._drop(key)
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions, expirations=self.expirations,
+                    entries=len(self._entries), bytes=self.bytes)
+
+    def _drop(self, key):
+        value, expires, nbytes = self._entries.pop(key)
+        self.bytes -= nbytes
+        if self.on_drop is not None:
+            self.on_drop(key)
+
+
+class TaggedCache(LRUCache):
+    '''
+    LRUCache whose entries carry tags, e.g. the tables a page read, so invalidate_tag() drops them all.
+    '''
+
+    def __init__(self, ttl=60, size=10000, max_bytes=None):
+        super(TaggedCache, self).__init__(ttl, size, max_bytes, on_drop=self._untag)
+        self._tags = {}
+        self._keys = {}
+
+    def put(self, key, value, tags=(), ttl=None):
+        super(TaggedCache, self).put(key, value, ttl)
+        if key not in self._entries:
+            return
+        self._keys[key] = frozenset(tags)
+        for tag in tags:
+            self._tags.setdefault(tag, set()).add(key)
+
+    def invalidate_tag(self, tag):
+        for key in list(self._tags.get(tag, ())):
+            self.invalidate(key)
+
+    def _untag(self, key):
+        for tag in self._keys.pop(key, ()):
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
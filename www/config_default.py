@@ -1,13 +1,112 @@
 '''
     Default configurations.
 '''
+
+import os
+
 configs = {
     'db': {
         'host': '127.0.0.1',
         'port': 3306,
         'user': 'www-data',
         'password': 'www-data',
-        'database': 'app_test'
+        'database': 'app_test',
+        # 只读从库，每项覆盖主库的host/port/user/password，例如 {'host': '10.0.0.2'}
+        'replicas': [],
+        # 写过主库的请求后续读也走主库
+        'sticky': True,
+        # 从库落后主库的秒数上限，表写入后这段时间内读到的不回填缓存
+        'replica_lag': 1.0,
+        # 超过该秒数的语句记入慢查询日志，参数只记录类型
+        'slow_query': 1.0,
+        # 单进程连接池大小；多进程时按max_connections平分给各worker
+        'minsize': 1,
+        'maxsize': 10,
+        # 数据库允许本应用使用的连接总数(每台库)
+        'max_connections': 100,
+        # 启动时预先建立的连接数
+        'warm_size': 5,
+        # 空闲超过该秒数的连接取出时先ping
+        'validate_idle': 30,
+        # 连接最长存活和空闲秒数，后台按recycle_interval回收，None为不回收
+        'max_lifetime': 3600,
+        'max_idle': 600,
+        'recycle_interval': 60,
+        # 设为True则相同的并发读查询只执行一次，模型可用__coalesce__ = False退出
+        'coalesce': False,
+        # 开发/测试时设为行数(如10000)，每种查询首次执行时EXPLAIN，扫描或排序这么多行的记警告
+        'explain': None
+    },
+    'server': {
+        'host': '127.0.0.1',
+        'port': 8090,
+        # server.py启动的worker数，0为CPU核数
+        'workers': 0,
+        # 有uvloop包时使用
+        'uvloop': True,
+        # SIGTERM后等待处理中请求完成的秒数
+        'shutdown_timeout': 30
+    },
+    'log': {
+        'level': 'INFO',
+        # 日志经队列由后台线程写出，不阻塞事件循环
+        'queue': True,
+        # 按INFO记录的请求比例
+        'sample': 1.0
+    },
+    'page_cache': {
+        # @cached()页面缓存的条目数和字节数上限
+        'size': 1000,
+        'max_bytes': 64 * 1024 * 1024
+    },
+    'templates': {
+        # 生产模式：不检查模板修改，启动时全部编译
+        'production': False,
+        # 编译结果的磁盘缓存目录，多个worker共享，None则不用
+        'bytecode_cache': None,
+        # {% cache %}片段缓存的条目数
+        'fragment_cache_size': 1000
+    },
+    'static': {
+        # 预压缩的编码，br需要brotli包
+        'encodings': ['br', 'gzip'],
+        # 小于该字节数的文件不压缩
+        'min_size': 1024,
+        # 不超过该大小的文件常驻内存，其余用sendfile
+        'memory_max_size': 64 * 1024,
+        'memory_max_bytes': 32 * 1024 * 1024
+    },
+    'compression': {
+        # 按优先顺序协商的编码，br需要brotli包
+        'encodings': ['br', 'gzip', 'deflate'],
+        # gzip/deflate的级别和br的quality
+        'level': 6,
+        'brotli_level': 4,
+        # 小于该字节数的响应不压缩
+        'min_size': 1024,
+        # 不小于该字节数的响应在线程池中压缩
+        'thread_min_size': 64 * 1024,
+        'threads': 2
+    },
+    'json': {
+        # auto优先用orjson，也可指定json或orjson
+        'encoder': 'auto'
+    },
+    'search': {
+        'enabled': True,
+        # 索引文件，不存在时启动时从数据库建立
+        'path': os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'search.idx'),
+        # 有修改时每隔该秒数保存一次
+        'save_interval': 300,
+        # 各worker每隔该秒数读入其他worker的修改
+        'sync_interval': 1
+    },
+    'ids': {
+        # 主键种类：legacy(varchar(50))、snowflake(bigint)或uuid(binary(16))
+        # 已有的库是varchar(50)的主键，改用snowflake或uuid时先停服务，在config_override.py里设置后运行migrate_ids.py
+        'kind': 'legacy',
+        # 写同一个库的各进程互不相同，0-1022(1023留给migrate_ids.py)；server.py的第i个worker用worker_id+i
+        'worker_id': 0
     },
     'session': {
         'secret': 'App-Test'
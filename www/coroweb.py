@@ -1,10 +1,10 @@
-import asyncio, os, inspect, logging, functools
-
-from urllib import parse
+import asyncio, os, inspect, logging, functools, time
 
 from aiohttp import web
 
-from apis import APIError
+from apis import APIError, APIValueError
+from assets import StaticFiles, restore_validators
+from metrics import REGISTRY, current_timer
 
 
 def get(path):
@@ -45,6 +45,23 @@ def post(path):
     return decorator
 
 
+def cached(ttl=60, max_age=0):
+    '''
+    Define decorator @cached() next to @get: cache the rendered response of the route by path and query
+    for ttl seconds, until a table it read is written. max_age is the Cache-Control max-age for clients,
+    who revalidate with the ETag. Only for pages that do not depend on the user.
+    :param ttl:
+    :param max_age:
+    :return:
+    '''
+
+    def decorator(func):
+        func.__cache__ = dict(ttl=ttl, max_age=max_age)
+        return func
+
+    return decorator
+
+
 def get_required_kw_args(fn):
     args = []
     params = inspect.signature(fn).parameters
@@ -93,74 +110,199 @@ def has_request_arg(fn):
     return found
 
 
+TRUE_VALUES = frozenset(['1', 'true', 'yes', 'on'])
+FALSE_VALUES = frozenset(['0', 'false', 'no', 'off', ''])
+
+
+def to_bool(value):
+    if isinstance(value, bool):
+        return value
+    v = str(value).lower()
+    if v in TRUE_VALUES:
+        return True
+    if v in FALSE_VALUES:
+        return False
+    raise ValueError('not a boolean: {!s}'.format(value))
+
+
+def get_converter(annotation):
+    '''
+    Return (convert, is_list) for a parameter annotation: int, float, bool, str, list or List[x].
+    convert is None when the value is passed through.
+    '''
+    if annotation is bool:
+        return to_bool, False
+    if annotation in (int, float):
+        return annotation, False
+    if annotation is list:
+        return None, True
+    if getattr(annotation, '__origin__', None) is list:
+        item = (getattr(annotation, '__args__', None) or (None,))[0]
+        return get_converter(item)[0], True
+    return None, False
+
+
+class ArgumentBinder(object):
+    '''
+    Bind request values to the keyword arguments of a handler, compiled once per handler.
+    Values come from the JSON or form body (POST) or the query string (GET), then match_info,
+    and are converted by the handler's annotations; a bad value raises APIValueError.
+    '''
+
+    def __init__(self, fn):
+        self.has_request_arg = has_request_arg(fn)
+        self.has_var_kw_arg = has_var_kw_arg(fn)
+        self.required = get_required_kw_args(fn)
+        # (name, convert, is_list) of every keyword only argument
+        self.named = []
+        for name, param in inspect.signature(fn).parameters.items():
+            if param.kind == inspect.Parameter.KEYWORD_ONLY:
+                self.named.append((name,) + get_converter(param.annotation))
+        self.converters = [n for n in self.named if n[1] is not None or n[2]]
+        self.parses = self.has_var_kw_arg or bool(self.named)
+
+    async def source(self, request):
+        '''
+        The body or query mapping of the request, None when there is none, or an HTTPBadRequest to return.
+        '''
+        if request.method == 'POST':
+            if not request.content_type:
+                return web.HTTPBadRequest(text='Missing Content-Type.')
+            ct = request.content_type.lower()
+            if ct.startswith('application/json'):
+                params = await request.json()
+                if not isinstance(params, dict):
+                    return web.HTTPBadRequest(text='JSON body must be object.')
+                return params
+            if ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
+                return (await request.post())
+            return web.HTTPBadRequest(text='Unsupported Content-Type: {!s}'.format(request.content_type))
+        if request.method == 'GET' and request.query_string:
+            return request.query
+        return None
+
+    async def bind(self, request):
+        '''
+        Return the keyword arguments of the handler, or an HTTPBadRequest to return.
+        '''
+        source = (await self.source(request)) if self.parses else None
+        if isinstance(source, web.HTTPException):
+            return source
+        match_info = request.match_info
+        if source is None:
+            kw = dict(match_info)
+            converters = self.converters
+        elif self.has_var_kw_arg:
+            kw = {k: source[k] for k in source}
+            for k, v in match_info.items():
+                if k in kw:
+                    logging.warning('Duplicate arg name in named arg and kw args: {!s}'.format(k))
+                kw[k] = v
+            converters = self.converters
+        else:
+            # 只取声明过的参数，取值时顺便做类型转换
+            kw = {}
+            getall = getattr(source, 'getall', None)
+            for name, convert, is_list in self.named:
+                if name in match_info:
+                    continue
+                if name not in source:
+                    # 缺少的参数不传，用函数的默认值或报缺少参数
+                    continue
+                value = getall(name) if is_list and getall is not None else source[name]
+                if value is not None and (convert is not None or is_list):
+                    value = self.convert(name, value, convert, is_list)
+                kw[name] = value
+            for k, v in match_info.items():
+                if k in source:
+                    logging.warning('Duplicate arg name in named arg and kw args: {!s}'.format(k))
+                kw[k] = v
+            converters = [n for n in self.converters if n[0] in match_info] if match_info else ()
+        for name, convert, is_list in converters:
+            if name in kw:
+                kw[name] = self.convert(name, kw[name], convert, is_list)
+        if self.has_request_arg:
+            kw['request'] = request
+        for name in self.required:
+            if name not in kw:
+                return web.HTTPBadRequest(text='Missing argument: {!s}'.format(name))
+        return kw
+
+    @staticmethod
+    def convert(name, value, convert, is_list):
+        try:
+            if is_list:
+                values = value if isinstance(value, list) else [value]
+                return values if convert is None else [convert(v) for v in values]
+            return convert(value)
+        except (TypeError, ValueError):
+            raise APIValueError(name, 'invalid value: {!s}'.format(value))
+
+
 class RequestHandler(object):
 
     def __init__(self, app, fn):
         self._app = app
         self._func = fn
-        self._has_request_arg = has_request_arg(fn)
-        self._has_var_kw_arg = has_var_kw_arg(fn)
-        self._has_named_kw_args = has_named_kw_args(fn)
-        self._named_kw_args = get_named_kw_args(fn)
-        self._required_kw_args = get_required_kw_args(fn)
+        self._binder = ArgumentBinder(fn)
+        self._route = getattr(fn, '__route__', None)
+        self.cache = getattr(fn, '__cache__', None)
 
     async def __call__(self, request):
-        kw = None
-        if self._has_var_kw_arg or self._has_named_kw_args or self._required_kw_args:
-            if request.method == 'POST':
-                if not request.content_type:
-                    return web.HTTPBadRequest('Missing Content-Type.')
-                ct = request.content_type.lower()
-                if ct.startswith('application/json'):
-                    params = await request.json()
-                    if not isinstance(params, dict):
-                        return web.HTTPBadRequest('JSON body must be object.')
-                    kw = params
-                elif ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
-                    params = await  request.post()
-                    kw = dict(**params)
-                else:
-                    return web.HTTPBadRequest('Unsupported Content-Type: {!s}'.format(request.content_type))
-            if request.method == 'GET':
-                qs = request.query_string
-                if qs:
-                    kw = dict()
-                    for k, v in parse.parse_qs(qs, True).items():
-                        kw[k] = v[0]
-        if kw is None:
-            kw = dict(**request.match_info)
-        else:
-            if not self._has_var_kw_arg and self._named_kw_args:
-                # remove all unamed kw:
-                copy = dict()
-                for name in self._named_kw_args:
-                    if name in kw:
-                        copy[name] = kw[name]
-                kw = copy
-            # check named arg:
-            for k, v in request.match_info.items():
-                if k in kw:
-                    logging.warning('Duplicate arg name in named arg and kw args: {!s}'.format(k))
-                kw[k] = v
-        if self._has_request_arg:
-            kw['request'] = request
-        # check required kw:
-        if self._required_kw_args:
-            for name in self._required_kw_args:
-                if name not in kw:
-                    return web.HTTPBadRequest('Missing argument: {!s}'.format(name))
-        logging.info('call with args: {!s}'.format(str(kw)))
+        timer = current_timer.get()
+        if timer is not None:
+            timer.route = self._route
+        start = time.perf_counter()
+        try:
+            kw = await self._binder.bind(request)
+        except APIError as e:
+            return e
+        if isinstance(kw, web.HTTPException):
+            return kw
+        logging.debug('call with args: %s', kw)
+        called = time.perf_counter()
         try:
             r = await self._func(**kw)
             return r
         except APIError as e:
-            return dict(error=e.error, data=e.data, message=e.message)
+            return e
+        finally:
+            if timer is not None:
+                timer.phases['parse'] += called - start
+                timer.phases['handler'] += time.perf_counter() - called
+
+
+def add_static(app, **kw):
+    ' serve www/static through assets.StaticFiles, and expose static_url() to templates. '
+    files = StaticFiles(**kw).scan()
+    app.router.add_route('GET', files.prefix + '{filename:.+}', files.handle)
+    app.on_response_prepare.append(restore_validators)
+    app['__static__'] = files
+    if '__templating__' in app:
+        app['__templating__'].globals['static_url'] = files.url
+    logging.info('add static {!s} => {!s}'.format(files.prefix, files.root))
+
+
+async def metrics(request):
+    resp = web.Response(body=REGISTRY.render().encode('utf-8'))
+    resp.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return resp
+
+
+def add_metrics(app, path='/metrics'):
+    app.router.add_route('GET', path, metrics)
+    logging.info('add metrics {!s}'.format(path))
 
 
-def add_static(app):
-    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
-    app.router.add_static('/static/', path)
-    logging.info('add static {!s} => {!s}'.format('/static/', path))
+def as_coroutine(fn):
+    ' what asyncio.coroutine did before Python 3.11: call fn and await its result when it is awaitable. '
+    @functools.wraps(fn)
+    async def wrapper(*args, **kw):
+        r = fn(*args, **kw)
+        if inspect.isawaitable(r):
+            r = await r
+        return r
+    return wrapper
 
 
 def add_route(app, fn):
@@ -169,7 +311,7 @@ def add_route(app, fn):
     if path is None or method is None:
         raise ValueError('@get or @post not defined in {!s}'.format(str(fn)))
     if not asyncio.iscoroutinefunction(fn) and not inspect.isgeneratorfunction(fn):
-        fn = asyncio.coroutine(fn)
+        fn = as_coroutine(fn)
     logging.info('add route {!s} {!s} => {!s}({!s})'.format(method, path, fn.__name__,
                                                             ','.join(inspect.signature(fn).parameters.keys())))
     app.router.add_route(method, path, RequestHandler(app, fn))
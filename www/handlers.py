@@ -4,12 +4,16 @@
 
 import re, time, json, logging, hashlib, base64, asyncio
 
-from coroweb import get, post
+from coroweb import get, post, cached
+
+from apis import APIValueError, APIResourceNotFoundError
+from search import docid
 
 from models import User, Comment, Blog, next_id
 
 
 @get('/users')
+@cached(ttl=60)
 async def user(request):
     users = await User.findall()
     return {
@@ -17,6 +21,7 @@ async def user(request):
         'users': users
     }
 @get('/')
+@cached(ttl=60)
 def index(request):
     summary = 'Lorem ipsum dolor sit amet, consectetur adipisicing elit, sed do eiusmod tempor incididunt ut labore et dolore magna aliqua.'
     blogs = [
@@ -28,3 +33,36 @@ def index(request):
         '__template__': 'blogs.html',
         'blogs': blogs
     }
+
+
+@get('/api/blogs')
+async def api_blogs(*, after=None, before=None, size: int = 20):
+    try:
+        page = await Blog.findpage(order_by='created_at', after=after, before=before, size=min(size, 100))
+    except ValueError as e:
+        raise APIValueError('cursor', str(e))
+    page['total'] = await Blog.count()
+    return page
+
+
+@get('/api/blogs/export')
+async def api_blogs_export():
+    return Blog.iterate(orderBy='created_at desc', defer=())
+
+
+@get('/api/search')
+async def api_search(*, q, kind=None, size: int = 20, request):
+    if not q.strip():
+        raise APIValueError('q', 'empty query')
+    if kind not in (None, Blog.__table__, Comment.__table__):
+        raise APIValueError('kind', 'unknown kind: {}'.format(kind))
+    index = request.app.get('__search__')
+    if index is None:
+        raise APIResourceNotFoundError('search', 'search is disabled')
+    hits = index.search(q, kind, min(size, 100))
+    blogs = await Blog.find_many([pk for k, pk, score in hits if k == Blog.__table__], defer=['content'])
+    comments = await Comment.find_many([pk for k, pk, score in hits if k == Comment.__table__])
+    found = {(Blog.__table__, docid(b.id)): b for b in blogs if b is not None}
+    found.update({(Comment.__table__, docid(c.id)): c for c in comments if c is not None})
+    items = [dict(kind=k, score=score, item=found[(k, pk)]) for k, pk, score in hits if (k, pk) in found]
+    return dict(items=items)
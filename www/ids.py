@@ -0,0 +1,126 @@
+'''
+    Primary key generators: 64-bit snowflake integers, 16-byte time-ordered uuids, or the legacy
+    50-character strings. Select one with use(), models take their keys from next_id().
+'''
+
+import os, time, uuid, binascii, logging
+
+# 2015-01-01 00:00:00 UTC，毫秒
+EPOCH = 1420070400000
+
+
+def legacy_id():
+    ' 15-digit millisecond timestamp, 32 hex digits of a random uuid and 000. '
+    return '{:0>15}{!s}000'.format(int(time.time() * 1000), uuid.uuid4().hex)
+
+
+class Snowflake(object):
+    '''
+    Integers of 41 bits of milliseconds since epoch, worker_bits of worker id and sequence_bits of
+    sequence within the millisecond, increasing in time order. Ids are above 2**53, so
+    serializers writes them to JSON as strings.
+
+    When the clock steps back the generator keeps counting from the last millisecond it issued,
+    borrowing milliseconds ahead when the sequence is exhausted, so ids never repeat or go down.
+    '''
+
+    def __init__(self, worker_id=0, epoch=EPOCH, worker_bits=10, sequence_bits=12, clock=time.time):
+        if not 0 <= worker_id < 1 << worker_bits:
+            raise ValueError('worker id must be in [0, {}): {}'.format(1 << worker_bits, worker_id))
+        self.worker_id = worker_id
+        self.epoch = epoch
+        self.sequence_bits = sequence_bits
+        self.time_shift = worker_bits + sequence_bits
+        self.sequence_mask = (1 << sequence_bits) - 1
+        self.worker = worker_id << sequence_bits
+        self.clock = clock
+        self.last = -1
+        self.sequence = 0
+        self.skewed = False
+
+    def __call__(self):
+        now = int(self.clock() * 1000) - self.epoch
+        if now > self.last:
+            if self.skewed:
+                logging.warning('snowflake: clock caught up after stepping back')
+                self.skewed = False
+            self.last = now
+            self.sequence = 0
+        else:
+            if now < self.last and not self.skewed:
+                logging.warning('snowflake: clock stepped back {} ms, ids run ahead of it'.format(self.last - now))
+                self.skewed = True
+            self.sequence = (self.sequence + 1) & self.sequence_mask
+            if self.sequence == 0:
+                # 本毫秒的序号用完，借用下一毫秒
+                self.last += 1
+        return (self.last << self.time_shift) | self.worker | self.sequence
+
+    def timestamp(self, value):
+        ' creation time in seconds of an id. '
+        return ((value >> self.time_shift) + self.epoch) / 1000
+
+
+class OrderedUUID(object):
+    '''
+    16 bytes laid out as a version 7 uuid: 48 bits of milliseconds since the unix epoch then
+    random bits, so that byte order is time order. The millisecond never goes back within a process.
+    '''
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.last = 0
+
+    def __call__(self):
+        self.last = max(self.last, int(self.clock() * 1000))
+        value = self.last << 80 | int.from_bytes(os.urandom(10), 'big')
+        # 版本7和RFC 4122变体位
+        value = value & ~(0xf << 76) | 7 << 76
+        value = value & ~(0x3 << 62) | 0x2 << 62
+        return value.to_bytes(16, 'big')
+
+    def timestamp(self, value):
+        return int.from_bytes(value[:6], 'big') / 1000
+
+
+def parse_uuid(value):
+    ' the 16 bytes of an ordered uuid given as bytes or as hex, with or without dashes. '
+    if isinstance(value, (bytes, bytearray)):
+        if len(value) != 16:
+            raise ValueError('invalid uuid: {!r}'.format(value))
+        return bytes(value)
+    try:
+        value = binascii.unhexlify(value.replace('-', ''))
+    except (binascii.Error, AttributeError):
+        raise ValueError('invalid uuid: {!r}'.format(value))
+    return parse_uuid(value)
+
+
+def text(value):
+    ' an id as a string for JSON and urls: hex for binary ids, which parse_uuid() reads back. '
+    return value.hex() if isinstance(value, bytes) else str(value)
+
+
+# 种类 => (生成器工厂, 列类型, 把请求参数等外部值转为列值)
+KINDS = {
+    'legacy': (lambda worker_id: legacy_id, 'varchar(50)', str),
+    'snowflake': (Snowflake, 'bigint', int),
+    'uuid': (lambda worker_id: OrderedUUID(), 'binary(16)', parse_uuid),
+}
+
+kind = 'legacy'
+generate = legacy_id
+
+
+def use(name, worker_id=0):
+    ' select the generator behind next_id(), worker_id tells apart the processes writing one database. '
+    global kind, generate
+    if name not in KINDS:
+        raise ValueError('unknown id kind: {}'.format(name))
+    kind = name
+    generate = KINDS[name][0](worker_id)
+    logging.info('ids: {} (worker {})'.format(name, worker_id))
+
+
+def next_id():
+    return generate()
@@ -0,0 +1,141 @@
+'''
+    In-process metrics rendered in the Prometheus text format.
+'''
+
+import bisect, contextvars
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')) for k, v in items) + '}'
+
+
+class Metric(object):
+    kind = 'untyped'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.kind)]
+        for labels, value in sorted(self.values.items()):
+            lines.append('{}{} {}'.format(self.name, format_labels(labels), value))
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + value
+
+
+class Gauge(Metric):
+    '''
+    Gauge set directly, or read at render time from collect() returning {labels dict as tuple: value}.
+    '''
+    kind = 'gauge'
+
+    def __init__(self, name, help, collect=None):
+        super(Gauge, self).__init__(name, help)
+        self.collect = collect
+
+    def set(self, value, **labels):
+        self.values[tuple(sorted(labels.items()))] = value
+
+    def render(self):
+        if self.collect is not None:
+            self.values = self.collect()
+        return super(Gauge, self).render()
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        h = self.values.get(key)
+        if h is None:
+            # 每个桶的计数(非累积)，加上+Inf、总和
+            h = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        h[0][bisect.bisect_left(self.buckets, value)] += 1
+        h[1] += value
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.kind)]
+        for labels, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for le, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(self.name, format_labels(labels, [('le', le)]), cumulative))
+            lines.append('{}_sum{} {}'.format(self.name, format_labels(labels), total))
+            lines.append('{}_count{} {}'.format(self.name, format_labels(labels), cumulative))
+        return lines
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help):
+        return self.metrics.get(name) or self.register(Counter(name, help))
+
+    def gauge(self, name, help, collect=None):
+        return self.metrics.get(name) or self.register(Gauge(name, help, collect))
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        return self.metrics.get(name) or self.register(Histogram(name, help, buckets))
+
+    def render(self):
+        lines = []
+        for name in sorted(self.metrics):
+            lines.extend(self.metrics[name].render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+request_seconds = REGISTRY.histogram('http_request_seconds', 'Request latency by route and phase.')
+# 当前请求的计时，由app.timing_factory设置
+current_timer = contextvars.ContextVar('request_timer', default=None)
+
+
+class RequestTimer(object):
+    '''
+    Time spent by one request in the parse, handler, db and render phases.
+    '''
+
+    def __init__(self):
+        self.route = None
+        self.phases = dict(parse=0.0, handler=0.0, db=0.0, render=0.0)
+
+    def record(self, method, route, total):
+        ' observe the phases, handler time excludes the db time spent inside it. '
+        self.phases['handler'] = max(self.phases['handler'] - self.phases['db'], 0.0)
+        request_seconds.observe(total, method=method, route=route, phase='total')
+        for phase, seconds in self.phases.items():
+            if seconds:
+                request_seconds.observe(seconds, method=method, route=route, phase=phase)
+
+
+def add_phase(phase, seconds):
+    timer = current_timer.get()
+    if timer is not None:
+        timer.phases[phase] += seconds
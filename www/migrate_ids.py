@@ -0,0 +1,131 @@
+'''
+    Convert legacy varchar(50) keys to the id kind of configs.ids, run as: python migrate_ids.py
+
+    Run it with the app stopped and the database backed up: the alter tables commit as they go.
+    New ids keep the order and creation time of the old ones, and are made with worker id
+    MIGRATION_WORKER so they never collide with ids of running workers. The old => new mapping is
+    left in the table id_map, e.g. to redirect old urls; tables already converted are skipped.
+'''
+
+import asyncio, os, time, logging
+
+import ids
+import orm
+from models import User, Blog, Comment
+from config import configs
+
+MODELS = (User, Blog, Comment)
+# 引用其他表主键的列 => 被引用的模型
+REFERENCES = dict(user_id=User, blog_id=Blog)
+MIGRATION_WORKER = 1023
+
+
+def generator(kind, now):
+    ' id generator of kind whose clock reads now[0], the time of the legacy id being converted. '
+    clock = lambda: now[0]
+    if kind == 'snowflake':
+        return ids.Snowflake(MIGRATION_WORKER, clock=clock)
+    return ids.OrderedUUID(clock=clock)
+
+
+def legacy_time(pk):
+    ' creation time of a legacy id from its 15-digit millisecond prefix. '
+    try:
+        return int(pk[:15]) / 1000
+    except ValueError:
+        return time.time()
+
+
+async def column_type(table, column):
+    # MySQL 8.0返回大写的列名，用别名
+    rs = await orm.select('select `data_type` `type` from information_schema.columns where `table_schema`=database() '
+                          'and `table_name`=? and `column_name`=?', [table, column], coalesce=False)
+    return rs[0]['type'].lower() if rs else None
+
+
+async def build_map(cls, make, now, batch=1000):
+    ' add old => new ids of every row of cls to id_map, in the order of the old ids. '
+    last, n = '', 0
+    while True:
+        rs = await orm.select('select `{0}` from `{1}` where `{0}` > ? order by `{0}` limit ?'.format(
+            cls.__primary_key__, cls.__table__), [last, batch], raw=True, coalesce=False)
+        if not rs:
+            return n
+        args = []
+        for (pk,) in rs:
+            now[0] = legacy_time(pk)
+            args.extend((cls.__table__, pk, make()))
+        await orm.execute('insert into `id_map` (`table_name`, `old_id`, `new_id`) values {}'.format(
+            ','.join(['(?, ?, ?)'] * len(rs))), args)
+        n += len(rs)
+        last = rs[-1][0]
+
+
+async def convert(cls, ddl):
+    ' rewrite the primary key and references of cls from id_map and swap the new columns in. '
+    table, pk = cls.__table__, cls.__primary_key__
+    refs = [c for c in cls.__fields__ if c in REFERENCES]
+    await orm.execute('alter table `{}` {}'.format(table, ', '.join(
+        'add column `new_{}` {} null'.format(c, ddl) for c in [pk] + refs)), [])
+    for column, target in [(pk, cls)] + [(c, REFERENCES[c]) for c in refs]:
+        await orm.execute('update `{0}` t join `id_map` m on m.`table_name`=? and m.`old_id`=t.`{1}` '
+                          'set t.`new_{1}`=m.`new_id`'.format(table, column), [target.__table__])
+    for column in refs:
+        rs = await orm.select('select count(*) `_num_` from `{0}` where `new_{1}` is null'.format(table, column), [],
+                              coalesce=False)
+        if rs[0]['_num_']:
+            # 指向已删除行的引用置0
+            logging.warning('{}.{}: {} references to missing rows set to 0'.format(table, column, rs[0]['_num_']))
+            await orm.execute('update `{0}` set `new_{1}`=0 where `new_{1}` is null'.format(table, column), [])
+    changes = ['drop primary key']
+    for column in [pk] + refs:
+        changes.append('drop column `{}`'.format(column))
+        changes.append('change `new_{0}` `{0}` {1} not null{2}'.format(column, ddl, ' first' if column == pk else ''))
+    changes.append('add primary key (`{}`)'.format(pk))
+    await orm.execute('alter table `{}` {}'.format(table, ', '.join(changes)), [])
+
+
+async def migrate(loop, batch=1000):
+    kind = configs.ids.kind
+    if kind == 'legacy':
+        logging.info('configs.ids.kind is legacy, nothing to migrate')
+        return
+    ddl = ids.KINDS[kind][1]
+    await orm.create_pool(loop, host=configs.db.host, port=configs.db.port, user=configs.db.user,
+                          password=configs.db.password, db=configs.db.database)
+    try:
+        await orm.execute('create table if not exists `id_map` (`table_name` varchar(50) not null, '
+                          '`old_id` varchar(50) not null, `new_id` {} not null, '
+                          'primary key (`table_name`, `old_id`)) engine=innodb default charset=utf8'.format(ddl), [])
+        pending = [cls for cls in MODELS if await column_type(cls.__table__, cls.__primary_key__) == 'varchar']
+        now = [0]
+        for cls in pending:
+            start = time.perf_counter()
+            # 每张表按自己的时间顺序从头生成
+            make = generator(kind, now)
+            await orm.execute('delete from `id_map` where `table_name`=?', [cls.__table__])
+            n = await build_map(cls, make, now, batch)
+            logging.info('mapped {} {} ids in {:.3f}s'.format(n, cls.__table__, time.perf_counter() - start))
+        for cls in pending:
+            start = time.perf_counter()
+            await convert(cls, ddl)
+            logging.info('converted {} in {:.3f}s'.format(cls.__table__, time.perf_counter() - start))
+        # 计数的分组键和搜索索引里还是旧id，重建
+        for cls in pending:
+            if cls.__counters__:
+                await orm.execute('delete from `counters` where `table_name`=?', [cls.__table__])
+                await cls.reconcile(batch)
+        if pending and os.path.exists(configs.search.path):
+            os.remove(configs.search.path)
+            if os.path.exists(configs.search.path + '.log'):
+                os.remove(configs.search.path + '.log')
+            logging.info('removed {}, it is rebuilt at the next start'.format(configs.search.path))
+    finally:
+        await orm.destroy_pool()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(migrate(loop))
+    loop.close()
@@ -1,44 +1,52 @@
-import time, uuid
+import time
 
-from orm import Model, StringField, BooleanField, FloatField, TextField
+import ids
+from ids import next_id
+from config import configs
+from orm import Model, StringField, BooleanField, FloatField, TextField, IdField
 
-
-def next_id():
-    return '{:0>15}{!s}000'.format(int(time.time() * 1000), uuid.uuid4().hex)
+# 字段的列类型由id种类决定，必须在定义模型前选定
+ids.use(configs.ids.kind, configs.ids.worker_id)
 
 
 class User(Model):
     __table__ = 'users'
+    __cache__ = dict(ttl=60, size=10000)
 
-    id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    email = StringField(ddl='varchar(50)')
+    id = IdField(primary_key=True, default=next_id)
+    email = StringField(ddl='varchar(50)', index='unique')
     passwd = StringField(ddl='varchar(50)')
     admin = BooleanField()
     name = StringField(ddl='varchar(50)')
     image = StringField(ddl='varchar(500)')
-    created_at = FloatField(default=time.time)
+    created_at = FloatField(default=time.time, index=True)
 
 
 class Blog(Model):
     __table__ = 'blogs'
+    __cache__ = dict(ttl=60, size=1000, max_bytes=64 * 1024 * 1024)
+    __counters__ = [(), 'user_id']
 
-    id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    user_id = StringField(ddl='varchar(50)')
+    id = IdField(primary_key=True, default=next_id)
+    user_id = IdField(index=True)
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
     name = StringField(ddl='varchar(100)')
     summary = StringField(ddl='varchar(200)')
-    content = TextField()
-    created_time = FloatField(default=time.time)
+    content = TextField(lazy=True, ddl='mediumtext')
+    created_at = FloatField(default=time.time, index=True)
 
 
 class Comment(Model):
     __table__ = 'comments'
+    __counters__ = ['blog_id']
+    # 按博客列出评论
+    __indexes__ = [('blog_id', 'created_at')]
 
-    id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    blog_id = StringField(ddl='varchar(50)')
-    user_id = StringField(ddl='varchar(50)')
+    id = IdField(primary_key=True, default=next_id)
+    blog_id = IdField()
+    user_id = IdField()
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
-    content = TextField()
-    created_time = FloatField(default=time.time)
+    content = TextField(ddl='mediumtext')
+    created_at = FloatField(default=time.time, index=True)
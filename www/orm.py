@@ -1,16 +1,213 @@
-import logging
+import asyncio, logging, json, base64, functools, contextlib, contextvars, re, time
 import aiomysql
 from datetime import datetime
 
+import ids
+from cache import LRUCache
+from pools import PoolRouter, wrote_primary
+from metrics import REGISTRY, add_phase
+
+# 批量语句的最大字节数，需小于MySQL的max_allowed_packet
+__max_packet = 1024 * 1024
+__router = None
+# 当前task所在的事务，见transaction()
+__transaction = contextvars.ContextVar('transaction', default=None)
+# 超过该秒数的语句记入慢查询日志
+__slow_query = 1.0
+# reading()期间select读到的表
+__tables_read = contextvars.ContextVar('tables_read', default=None)
+# 写表时调用listener(table)，用于失效缓存
+write_listeners = []
+# 模型写入后调用listener(event, cls, objs)，event为save/update/remove，事务中的在提交后调用
+model_listeners = []
+# 表名 => 模型
+models_by_table = {}
+# 当前请求的按主键批量加载器，见batching()
+__loader = contextvars.ContextVar('loader', default=None)
+# 合并进行中的相同读查询，(sql, args, size, raw) => Task
+__coalesce = False
+__inflight = {}
+# 开发/测试用：不为None时每种select形状首次执行后EXPLAIN一次，估计扫描不少于该行数的全表扫描或filesort记警告
+__explain = None
+__explained = set()
+
+TABLE_READ = re.compile(r'\b(?:from|join)\s+`(\w+)`', re.I)
+TABLE_WRITTEN = re.compile(r'\s*(?:insert\s+into|replace\s+into|update|delete\s+from)\s+`(\w+)`', re.I)
+
+sql_seconds = REGISTRY.histogram('orm_sql_seconds', 'SQL statement latency by statement shape.')
+sql_rows = REGISTRY.counter('orm_sql_rows_total', 'Rows returned or affected by statement shape.')
+sql_errors = REGISTRY.counter('orm_sql_errors_total', 'Failed SQL statements by statement shape.')
+sql_coalesced = REGISTRY.counter('orm_sql_coalesced_total', 'Selects that waited for an identical one in flight.')
+sql_flagged = REGISTRY.counter('orm_sql_flagged_total', 'Select shapes whose plan scans or filesorts a large table.')
+
 
 def log(sql, args=()):
-    logging.info('SQL: {}'.format(sql))
+    logging.debug('SQL: %s', sql)
 
 
-async def create_pool(loop, **kw):
-    logging.info(str(datetime.now()) + ":create database connection pool....")
-    global __pool
-    __pool = await aiomysql.create_pool(
+def collapse_sql(sql):
+    sql = re.sub(r'\?(?:\s*,\s*\?)+', '?, ...', sql)
+    return re.sub(r'(\(\?, \.\.\.\))(?:\s*,\s*\(\?, \.\.\.\))+', r'\1, ...', sql)
+
+
+@functools.lru_cache(maxsize=1024)
+def cached_shape(sql):
+    return collapse_sql(sql)
+
+
+def sql_shape(sql):
+    '''
+        statement shape used as metric label, with placeholder lists and multi-row values collapsed.
+        long bulk statements are not cached.
+    '''
+    return cached_shape(sql) if len(sql) < 4096 else collapse_sql(sql)
+
+
+@functools.lru_cache(maxsize=1024)
+def tables_of(sql):
+    ' tables a select reads from. '
+    return frozenset(TABLE_READ.findall(sql))
+
+
+def track_read(sql):
+    tables = __tables_read.get()
+    if tables is not None:
+        tables.update(tables_of(sql))
+
+
+def track_table(table):
+    ' record a table read without a select, e.g. answered from a cache. '
+    tables = __tables_read.get()
+    if tables is not None:
+        tables.add(table)
+
+
+@contextlib.contextmanager
+def reading():
+    ' collect the tables read by selects inside the block into the yielded set. '
+    tables = set()
+    token = __tables_read.set(tables)
+    try:
+        yield tables
+    finally:
+        __tables_read.reset(token)
+
+
+class WriteClock(object):
+    '''
+    Counts the table writes seen by this process, remembering the count and time of the last write
+    of each table. A cache filled from reads begun at mark() keeps the result only if fresh(): no
+    table read was written since, nor within settle seconds, the time replicas may lag behind.
+    '''
+
+    def __init__(self, settle=0):
+        self.settle = settle
+        self.count = 0
+        self.last = {}
+
+    def tick(self, table):
+        self.count += 1
+        self.last[table] = (self.count, time.monotonic())
+
+    def mark(self):
+        return self.count
+
+    def fresh(self, mark, tables):
+        now = time.monotonic()
+        for table in tables:
+            last = self.last.get(table)
+            if last is not None and (last[0] > mark or now - last[1] < self.settle):
+                return False
+        return True
+
+
+write_clock = WriteClock()
+
+
+def written(table):
+    write_clock.tick(table)
+    for listener in write_listeners:
+        listener(table)
+
+
+def written_elsewhere(table):
+    '''
+        another process wrote table: drop the entities and counts cached from it in this one, then
+        tell write_listeners as for a local write.
+    '''
+    for cls in models_by_table.get(table, ()):
+        if cls.__entity_cache__ is not None:
+            cls.__entity_cache__.clear()
+    if table == 'counters':
+        for classes in models_by_table.values():
+            for cls in classes:
+                if cls.__counter_cache__ is not None:
+                    cls.__counter_cache__.clear()
+    written(table)
+
+
+def notify_write(sql):
+    ' tell write_listeners the table written by sql, again after commit inside a transaction. '
+    m = TABLE_WRITTEN.match(sql)
+    if m is None:
+        return
+    table = m.group(1)
+    loader = __loader.get()
+    if loader is not None:
+        loader.forget(table)
+    tx = __transaction.get()
+    if tx is not None:
+        tx.tables.add(table)
+    written(table)
+
+
+def notify_model(event, cls, objs):
+    ' tell model_listeners that objs were saved, updated or removed, after commit inside a transaction. '
+    tx = __transaction.get()
+    if tx is not None:
+        tx.events.append((event, cls, objs))
+        return
+    for listener in model_listeners:
+        listener(event, cls, objs)
+
+
+def redact(args):
+    ' bound arguments as their types only, for logs. '
+    return '[{}]'.format(', '.join(type(a).__name__ for a in args or ()))
+
+
+def observe(sql, args, seconds, rows, error):
+    add_phase('db', seconds)
+    shape = sql_shape(sql)
+    sql_seconds.observe(seconds, sql=shape)
+    sql_rows.inc(rows, sql=shape)
+    if error:
+        sql_errors.inc(sql=shape)
+    if seconds >= __slow_query:
+        logging.warning('slow query {:.3f}s: {} args: {}'.format(seconds, shape, redact(args)))
+
+
+class QueryStat(object):
+    '''
+    Time a statement in a with block and record it, the block sets rows.
+    '''
+
+    def __init__(self, sql, args):
+        self.sql = sql
+        self.args = args
+        self.rows = 0
+        self.error = False
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        observe(self.sql, self.args, time.perf_counter() - self.start, self.rows, self.error or exc_type is not None)
+
+
+async def connect(loop, **kw):
+    return (await aiomysql.create_pool(
         host=kw.get('host', 'localhost'),
         port=kw.get('port', 3306),
         user=kw['user'],
@@ -21,57 +218,561 @@ async def create_pool(loop, **kw):
         maxsize=kw.get('maxsize', 10),
         minsize=kw.get('minsize', 1),
         loop=loop
-    )
+    ))
+
+
+async def create_pool(loop, **kw):
+    '''
+        create the primary pool, and one pool per dict in replicas which overrides
+        the primary settings (host, port, ...). selects go to replicas, writes to the primary.
+        each pool opens warm_size connections before returning; idle connections are pinged on
+        checkout after validate_idle seconds and recycled after max_lifetime / max_idle seconds.
+        with replicas, reads do not fill caches for replica_lag seconds after their tables are written, see WriteClock.
+        with coalesce=True identical concurrent selects share one query, see select().
+        explain=rows checks the plan of every select shape once, see explaining().
+    '''
+    logging.info(str(datetime.now()) + ":create database connection pool....")
+    global __max_packet, __slow_query, __coalesce, __explain
+    __max_packet = kw.get('max_packet', 1024 * 1024)
+    __slow_query = kw.get('slow_query', 1.0)
+    __coalesce = kw.get('coalesce', False)
+    __explain = kw.get('explain')
+    replicas = kw.pop('replicas', None) or []
+    primary = await connect(loop, **kw)
+    replica_pools = []
+    for replica in replicas:
+        replica_pools.append(await connect(loop, **dict(kw, **replica)))
+    # 从库可能落后，表写入后这段时间内从库读到的不回填缓存
+    write_clock.settle = kw.get('replica_lag', 1.0) if replicas else 0
+    use_pools(primary, replica_pools, sticky=kw.get('sticky', True), warm_size=kw.get('warm_size', 0),
+              validate_idle=kw.get('validate_idle'), max_lifetime=kw.get('max_lifetime'),
+              max_idle=kw.get('max_idle'))
+    # 预先建立连接，开始接受请求前完成握手
+    start = time.perf_counter()
+    await __router.warm()
+    logging.info('warmed pools to {} connections in {:.3f}s'.format(kw.get('warm_size', 0),
+                                                                     time.perf_counter() - start))
+    __router.start(loop, kw.get('check_interval', 5), kw.get('recycle_interval', 60))
+
+
+class Loader(object):
+    '''
+    Batch the find() calls of one request: primary keys asked for during one event loop tick are
+    fetched with one find_many() per model, and remembered for the rest of the request until
+    the request writes to their table.
+    '''
+
+    def __init__(self):
+        # model => {pk: future}，本轮要查的主键
+        self.pending = {}
+        # (model, pk) => row，本请求已查到的
+        self.loaded = {}
+        self.scheduled = False
+        # 写表次数，写之前发出的查询结果不再记住
+        self.writes = 0
+
+    def forget(self, table):
+        ' drop the remembered rows of table, called for every write of the request. '
+        self.writes += 1
+        for key in [key for key in self.loaded if key[0].__table__ == table]:
+            del self.loaded[key]
+
+    async def load(self, cls, pk):
+        # 本请求已查到或等待同一轮查询时，select记录不到读的表
+        track_table(cls.__table__)
+        key = (cls, pk)
+        if key in self.loaded:
+            row = self.loaded[key]
+            return None if row is None else cls(**row)
+        futures = self.pending.setdefault(cls, {})
+        fut = futures.get(pk)
+        if fut is None:
+            loop = asyncio.get_event_loop()
+            fut = futures[pk] = loop.create_future()
+            if not self.scheduled:
+                # 同一轮里其他task的find()都登记后再查
+                self.scheduled = True
+                loop.call_soon(self.dispatch)
+        row = await asyncio.shield(fut)
+        return None if row is None else cls(**row)
+
+    def dispatch(self):
+        pending, self.pending, self.scheduled = self.pending, {}, False
+        for cls, futures in pending.items():
+            asyncio.ensure_future(self.fetch(cls, futures))
+
+    async def fetch(self, cls, futures):
+        writes = self.writes
+        try:
+            objs = await cls.find_many(list(futures))
+        except Exception as e:
+            for fut in futures.values():
+                fut.set_exception(e)
+            return
+        for (pk, fut), obj in zip(futures.items(), objs):
+            if writes == self.writes:
+                self.loaded[(cls, pk)] = obj
+            fut.set_result(obj)
+
+
+def in_transaction():
+    return __transaction.get() is not None
+
+
+def invalidate_entities(cls, pks):
+    ' drop pks from the entity cache of cls, again after commit inside a transaction. '
+    # 缓存的键是find()解析过的主键
+    parse = cls.__mappings__[cls.__primary_key__].parse
+    pks = [parse(pk) for pk in pks]
+    for pk in pks:
+        cls.__entity_cache__.invalidate(pk)
+    tx = __transaction.get()
+    if tx is not None:
+        tx.invalidated.append((cls, pks))
+
+
+def current_loader():
+    ' the Loader of the current request, None outside batching() and inside transactions. '
+    if __transaction.get() is not None:
+        return None
+    return __loader.get()
+
+
+@contextlib.contextmanager
+def batching():
+    ' batch and remember Model.find() by primary key inside the block, see Loader. '
+    token = __loader.set(Loader())
+    try:
+        yield
+    finally:
+        __loader.reset(token)
+
+
+class Transaction(object):
+    '''
+    The connection held by a transaction() scope and its savepoint nesting depth.
+    '''
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.depth = 0
+        self.tables = set()
+        self.events = []
+        # (model, 主键)，提交后再从实体缓存失效
+        self.invalidated = []
+
+    def mark(self):
+        ' the queued after-commit work so far, to drop what a rolled back savepoint added. '
+        return set(self.tables), len(self.events), len(self.invalidated)
+
+    def rollback_to(self, mark):
+        tables, events, invalidated = mark
+        self.tables = tables
+        del self.events[events:]
+        del self.invalidated[invalidated:]
+
+
+@contextlib.asynccontextmanager
+async def transaction():
+    '''
+        async with orm.transaction(): run every statement inside, including Model.save()/update()/find(),
+        on one primary connection with a single commit, rolling back if an exception escapes.
+        nested scopes become savepoints. statements of a scope must be awaited one at a time.
+    '''
+    tx = __transaction.get()
+    if tx is not None:
+        tx.depth += 1
+        savepoint = 'sp{}'.format(tx.depth)
+        mark = tx.mark()
+        async with tx.conn.cursor() as cur:
+            await cur.execute('savepoint {}'.format(savepoint))
+            try:
+                yield tx
+            except BaseException:
+                await cur.execute('rollback to savepoint {}'.format(savepoint))
+                # 回滚掉的写不再在提交后通知
+                tx.rollback_to(mark)
+                raise
+            else:
+                await cur.execute('release savepoint {}'.format(savepoint))
+            finally:
+                tx.depth -= 1
+        return
+    async with __router.connection() as conn:
+        await conn.begin()
+        tx = Transaction(conn)
+        token = __transaction.set(tx)
+        try:
+            yield tx
+        except BaseException:
+            await conn.rollback()
+            raise
+        else:
+            await conn.commit()
+        finally:
+            __transaction.reset(token)
+    __router.wrote()
+    # 提交后再失效一次，避免提交前被并发读回填旧数据
+    for table in tx.tables:
+        written(table)
+    for cls, pks in tx.invalidated:
+        for pk in pks:
+            cls.__entity_cache__.invalidate(pk)
+    for event in tx.events:
+        for listener in model_listeners:
+            listener(*event)
+
+
+@contextlib.asynccontextmanager
+async def connection(read=False):
+    ' the connection of the current transaction, or a routed pool connection. '
+    tx = __transaction.get()
+    if tx is not None:
+        yield tx.conn
+    else:
+        async with __router.connection(read) as conn:
+            yield conn
+
+
+def use_pools(primary, replicas=(), sticky=True, **kw):
+    ' route queries to already created pools, or to local stand-ins. '
+    global __router
+    __router = PoolRouter(primary, replicas, sticky, **kw)
+    return __router
 
 
 async def destroy_pool():
     logging.info(str(datetime.now()) + ":destroy database connection pool....")
-    global __pool
-    if __pool is not None:
-        __pool.close()
-        await __pool.wait_closed()
+    global __router
+    if __router is not None:
+        await __router.close()
+        __router = None
 
 
-async def select(sql, args, size=None):
-    log(sql, args)
-    global __pool
-    # with (await __pool) as conn:
-    async with __pool.get() as conn:
-        # cur = await conn.cursor(aiomysql.DictCursor)
+def coalescing(enabled=True):
+    ' turn coalescing of identical concurrent selects on or off. '
+    global __coalesce
+    __coalesce = enabled
+
+
+def explaining(min_rows=10000):
+    '''
+        for development and tests: EXPLAIN each new select shape once, and log a warning when the plan
+        fully scans or filesorts a table of about min_rows rows or more. None turns it off.
+    '''
+    global __explain
+    __explain = min_rows
+    __explained.clear()
+
+
+def plan_problems(plan, min_rows):
+    ' full scans and filesorts of at least min_rows estimated rows in the rows of an EXPLAIN. '
+    problems = []
+    for step in plan:
+        rows = step.get('rows') or 0
+        if rows < min_rows:
+            continue
+        if step.get('type') == 'ALL':
+            problems.append('full scan of `{}` (~{} rows)'.format(step.get('table'), rows))
+        if 'Using filesort' in (step.get('Extra') or ''):
+            problems.append('filesort of `{}` (~{} rows)'.format(step.get('table'), rows))
+    return problems
+
+
+async def check_plan(conn, sql, args):
+    shape = sql_shape(sql)
+    if shape in __explained:
+        return
+    __explained.add(shape)
+    try:
         async with conn.cursor(aiomysql.DictCursor) as cur:
-            await cur.execute(sql.replace('?', '%s'), args or ())
-            if size:
-                rs = await cur.fetchmany(size)
-            else:
-                rs = await  cur.fetchall()
-            await cur.close()
-        logging.info('rows returned: {}'.format(len(rs)))
-        return rs
+            await cur.execute('explain ' + compile_sql(sql), args or ())
+            plan = await cur.fetchall()
+    except Exception as e:
+        logging.warning('explain failed: {}: {}'.format(e, shape))
+        return
+    for problem in plan_problems(plan, __explain):
+        sql_flagged.inc(sql=shape)
+        logging.warning('query plan: {}: {}'.format(problem, shape))
+
+
+def coalescestats():
+    ' selects that shared the result of an identical one in flight, by statement shape. '
+    return {dict(labels)['sql']: n for labels, n in sql_coalesced.values.items()}
+
+
+async def select(sql, args, size=None, raw=False, coalesce=True):
+    '''
+        select rows as dicts, or as plain tuples in column order when raw is True.
+        when coalescing is on, a select identical to one in flight (same sql, args, size and raw)
+        waits for that one and gets the same rows instead of taking another connection; the rows
+        are shared, so callers must not modify them. pass coalesce=False to always query.
+    '''
+    log(sql, args)
+    track_read(sql)
+
+    async def fetch(conn):
+        async with conn.cursor(aiomysql.Cursor if raw else aiomysql.DictCursor) as cur:
+            with QueryStat(sql, args) as stat:
+                await cur.execute(compile_sql(sql), args or ())
+                if size:
+                    rs = await cur.fetchmany(size)
+                else:
+                    rs = await cur.fetchall()
+                stat.rows = len(rs)
+            if __explain is not None:
+                await check_plan(conn, sql, args)
+            return rs
+
+    tx = __transaction.get()
+    if tx is not None:
+        rs = await fetch(tx.conn)
+    elif __coalesce and coalesce and not wrote_primary.get():
+        # 事务内和写后读主库的查询不合并，它们要看到自己的写
+        rs = await shared(sql, args, size, raw, fetch)
+    else:
+        rs = await __router.run(fetch, read=True)
+    logging.debug('rows returned: %s', len(rs))
+    return rs
+
+
+async def shared(sql, args, size, raw, fetch):
+    key = (sql, tuple(args or ()), size, raw)
+    try:
+        task = __inflight.get(key)
+    except TypeError:
+        return (await __router.run(fetch, read=True))
+    if task is None:
+        # 查询在独立的task里运行，发起者被取消不影响其他等待者
+        task = asyncio.ensure_future(__router.run(fetch, read=True))
+        __inflight[key] = task
+        task.add_done_callback(lambda t: __inflight.pop(key, None))
+    else:
+        sql_coalesced.inc(sql=sql_shape(sql))
+    return (await asyncio.shield(task))
+
+
+async def select_iter(sql, args, batch=500, raw=False):
+    '''
+        iterate rows of a select through an unbuffered server side cursor,
+        fetching batch rows at a time so memory stays bounded.
+        the connection is held until the iteration finishes or is closed.
+    '''
+    log(sql, args)
+    track_read(sql)
+    async with connection(read=True) as conn:
+        async with conn.cursor(aiomysql.SSCursor if raw else aiomysql.SSDictCursor) as cur:
+            with QueryStat(sql, args):
+                await cur.execute(compile_sql(sql), args or ())
+            while True:
+                rs = await cur.fetchmany(batch)
+                if not rs:
+                    break
+                for r in rs:
+                    yield r
 
 
 async def execute(sql, args, autocommit=True):
     log(sql)
+    tx = __transaction.get()
+    if tx is not None:
+        # 在事务中不吞掉异常，让transaction()回滚
+        async with tx.conn.cursor() as cur:
+            with QueryStat(sql, args) as stat:
+                await cur.execute(compile_sql(sql), args)
+                stat.rows = cur.rowcount
+            notify_write(sql)
+            return cur.rowcount
     # with (await __pool) as conn:
-    async with __pool.get() as conn:
+    async with __router.connection() as conn:
         if not autocommit:
             await conn.begin()
         try:
             # cur = await conn.cursor()
             async with conn.cursor(aiomysql.DictCursor) as cur:
-                try:
-                    await cur.execute(sql.replace('?', '%s'), args)
-                except Exception as e:
-                    print(str(e))
-                affected = cur.rowcount
+                with QueryStat(sql, args) as stat:
+                    try:
+                        await cur.execute(compile_sql(sql), args)
+                    except Exception as e:
+                        stat.error = True
+                        print(str(e))
+                    affected = stat.rows = cur.rowcount
                 if not autocommit:
                     await conn.commit()
         except BaseException as e:
             if not autocommit:
                 await conn.rollback()
             raise
+        __router.wrote()
+        notify_write(sql)
         return affected
 
 
+async def execute_many(chunks):
+    '''
+        execute chunks of (sql, args) statements on one connection inside one transaction,
+        return the affected rows of each chunk.
+    '''
+    logging.debug('SQL batch: %s chunks', len(chunks))
+    tx = __transaction.get()
+    if tx is not None:
+        return (await execute_chunks(tx.conn, chunks))
+    async with __router.connection() as conn:
+        await conn.begin()
+        try:
+            affected = await execute_chunks(conn, chunks)
+            await conn.commit()
+        except BaseException:
+            await conn.rollback()
+            raise
+        __router.wrote()
+    # 提交后再通知一次，提交前被并发读回填的缓存也失效
+    for statements in chunks:
+        for sql, args in statements:
+            notify_write(sql)
+    return affected
+
+
+async def execute_chunks(conn, chunks):
+    affected = []
+    async with conn.cursor() as cur:
+        for statements in chunks:
+            rows = 0
+            for sql, args in statements:
+                with QueryStat(sql, args) as stat:
+                    # 多行语句的形状随行数变化，不放进语句缓存
+                    await cur.execute(sql.replace('?', '%s'), args)
+                    stat.rows = cur.rowcount
+                rows += cur.rowcount
+                notify_write(sql)
+            affected.append(rows)
+    return affected
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_sql(sql):
+    ' translate ? placeholders into the driver paramstyle, once per distinct statement. '
+    return sql.replace('?', '%s')
+
+
+@functools.lru_cache(maxsize=1024)
+def select_sql(cls, columns=None):
+    ' select clause of a projection, columns is a tuple starting with the primary key or None for all. '
+    if columns is None:
+        return cls.__select__
+    return 'select {} from `{}`'.format(', '.join('`{}`'.format(c) for c in columns), cls.__table__)
+
+
+@functools.lru_cache(maxsize=1024)
+def update_sql(cls, fields):
+    ' update statement of the given non primary key fields. '
+    if fields == tuple(cls.__fields__):
+        return cls.__update__
+    return 'update `{}` set {} where `{}`=?'.format(cls.__table__, ', '.join('`{}`=?'.format(
+        cls.__mappings__[f].name or f) for f in fields), cls.__primary_key__)
+
+
+@functools.lru_cache(maxsize=1024)
+def findall_sql(cls, where, orderBy, limit, columns=None):
+    '''
+        build the statement of one findall shape, limit is None, 1 for 'limit ?' or 2 for 'limit ?,?'.
+    '''
+    sql = [select_sql(cls, columns)]
+    if where:
+        sql.append('where')
+        sql.append(where)
+    if orderBy:
+        sql.append('order by')
+        sql.append(orderBy)
+    if limit == 1:
+        sql.append('limit ?')
+    elif limit == 2:
+        sql.append('limit ?,?')
+    return ' '.join(sql)
+
+
+@functools.lru_cache(maxsize=1024)
+def findpage_sql(cls, where, order_by, ascending, keyset, columns=None):
+    ' build the statement of one findpage shape. '
+    pk = cls.__primary_key__
+    sql = [select_sql(cls, columns)]
+    conditions = []
+    if where:
+        conditions.append('({})'.format(where))
+    if keyset:
+        op = '>' if ascending else '<'
+        # a<=? and (a<? or pk<?) 可以直接走(a, pk)索引的范围扫描
+        conditions.append('`{0}` {1}= ? and (`{0}` {1} ? or `{2}` {1} ?)'.format(order_by, op, pk))
+    if conditions:
+        sql.append('where')
+        sql.append(' and '.join(conditions))
+    direction = 'asc' if ascending else 'desc'
+    sql.append('order by `{0}` {2}, `{1}` {2} limit ?'.format(order_by, pk, direction))
+    return ' '.join(sql)
+
+
+def estimate_args_size(args):
+    ' rough size of the escaped literals the driver will send for args. '
+    size = 0
+    for arg in args:
+        if isinstance(arg, str):
+            size += len(arg.encode('utf-8')) + 3
+        else:
+            size += len(str(arg)) + 1
+    return size
+
+
+def chunk_rows(rows, row_size, max_packet=None):
+    '''
+        split rows into chunks whose statements fit in max_packet bytes.
+        row_size(row) returns the size one row adds to the statement.
+    '''
+    if max_packet is None:
+        max_packet = __max_packet
+    chunk, size = [], 0
+    for row in rows:
+        n = row_size(row)
+        if chunk and size + n > max_packet:
+            yield chunk
+            chunk, size = [], 0
+        chunk.append(row)
+        size += n
+    if chunk:
+        yield chunk
+
+
+def encode_cursor(value, pk):
+    ' opaque, url safe page cursor for a (sort value, primary key) position, binary ids as hex. '
+    return base64.urlsafe_b64encode(json.dumps([value, pk], default=ids.text).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        value, pk = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii') + b'=' * (-len(cursor) % 4)).decode('utf-8'))
+    except (ValueError, TypeError, UnicodeError):
+        raise ValueError('Invalid cursor: {}'.format(cursor))
+    return value, pk
+
+
+def index_name(columns):
+    return 'idx_' + '_'.join(columns)
+
+
+def column_ddl(column, field):
+    return '`{}` {} not null'.format(column, field.column_type)
+
+
+def create_table_sql(cls):
+    ' create table statement of a model, with its declared indexes. '
+    lines = [column_ddl(f.name or k, f) for k, f in cls.__mappings__.items()]
+    for name, columns, unique in cls.__indexes__:
+        lines.append('{}key `{}` ({})'.format('unique ' if unique else '', name,
+                                              ', '.join('`{}`'.format(c) for c in columns)))
+    lines.append('primary key (`{}`)'.format(cls.__primary_key__))
+    return 'create table `{}` (\n    {}\n) engine=innodb default charset=utf8;'.format(
+        cls.__table__, ',\n    '.join(lines))
+
+
 def create_args_string(num):
     L = []
     for n in range(num):
@@ -79,40 +780,214 @@ def create_args_string(num):
     return ', '.join(L)
 
 
+class Row(object):
+    '''
+    Compact, slot based row of a model. ModelMetaclass creates one subclass per model as __row__,
+    with one slot per column in select order, hydrated positionally from a plain tuple cursor.
+    '''
+    __slots__ = ()
+    __columns__ = ()
+    # 编码为JSON字符串的id列
+    __ids__ = frozenset()
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return hasattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def keys(self):
+        return [k for k in self.__columns__ if hasattr(self, k)]
+
+    def items(self):
+        return [(k, getattr(self, k)) for k in self.keys()]
+
+    def todict(self):
+        return dict(self.items())
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.items() == other.items()
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, ', '.join('{}={!r}'.format(k, v) for k, v in self.items()))
+
+
+def row_init(columns):
+    ' generate a positional __init__ assigning the given columns, like namedtuple. '
+    ns = {}
+    exec('def __init__(self, {0}):\n    {1} = {0}'.format(', '.join(columns), ', '.join(
+        'self.' + c for c in columns)), ns)
+    return ns['__init__']
+
+
+def create_row_class(name, columns):
+    ' create the Row subclass of a model. '
+    return type(name + 'Row', (Row,), dict(__slots__=tuple(columns), __columns__=tuple(columns),
+                                            __init__=row_init(columns)))
+
+
+@functools.lru_cache(maxsize=256)
+def projected_row_class(cls, columns):
+    ' Row class hydrating a projection, columns missing from it are left unset until loaded. '
+    if columns is None:
+        return cls.__row__
+    return type(cls.__row__.__name__, (cls.__row__,), dict(__slots__=(), __init__=row_init(columns)))
+
+
 class Field(object):
-    def __init__(self, name, column_type, primary_key, default):
+    def __init__(self, name, column_type, primary_key, default, lazy=False, index=False):
         self.name = name
         self.column_type = column_type
         self.primary_key = primary_key
         self.default = default
+        # lazy的字段不在列表查询中加载，需要时用load()/load_many()取回
+        self.lazy = lazy
+        # True建普通索引，'unique'建唯一索引，多列索引用模型的__indexes__
+        self.index = index
 
     def __str__(self):
         return '<{}, {}:{}>'.format(self.__class__.__name__, self.column_type, self.name)
 
+    def parse(self, value):
+        ' the column value of a value from outside, e.g. a url parameter. '
+        return value
+
 
 class StringField(Field):
-    def __init__(self, name=None, primary_key=False, default=None, ddl='varchar(100)'):
-        super().__init__(name, ddl, primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=None, ddl='varchar(100)', index=False):
+        super().__init__(name, ddl, primary_key, default, index=index)
 
 
 class BooleanField(Field):
-    def __init__(self, name=None, default=False):
-        super().__init__(name, 'boolean', False, default)
+    def __init__(self, name=None, default=False, index=False):
+        super().__init__(name, 'boolean', False, default, index=index)
 
 
 class IntegerField(Field):
-    def __init__(self, name=None, primary_key=False, default=0):
-        super().__init__(name, 'bigint', primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=0, index=False):
+        super().__init__(name, 'bigint', primary_key, default, index=index)
 
 
 class FloatField(Field):
-    def __init__(self, name=None, primary_key=False, default=0.0):
-        super().__init__(name, 'real', primary_key, default)
+    def __init__(self, name=None, primary_key=False, default=0.0, index=False):
+        super().__init__(name, 'real', primary_key, default, index=index)
+
+
+class IdField(Field):
+    '''
+        a key made by ids.next_id(), or a reference to one: bigint for snowflake ids, binary(16) for
+        ordered uuids and varchar(50) for legacy ids, as selected by kind or else by ids.use().
+    '''
+
+    def __init__(self, name=None, primary_key=False, default=None, kind=None, index=False):
+        self.kind = kind or ids.kind
+        factory, ddl, self.parse = ids.KINDS[self.kind]
+        super().__init__(name, ddl, primary_key, default, index=index)
 
 
 class TextField(Field):
-    def __init__(self, name=None, default=None):
-        super().__init__(name, 'text', False, default)
+    def __init__(self, name=None, default=None, lazy=False, ddl='text'):
+        super().__init__(name, ddl, False, default, lazy)
+
+
+COUNTER_UPSERT = 'insert into `counters` (`table_name`, `group_by`, `group_key`, `n`, `updated_at`) values {} ' \
+                 'on duplicate key update `n`={}, `updated_at`=values(`updated_at`)'
+COUNTER_ROW = '(?, ?, ?, ?, ?)'
+COUNTER_TABLE = '''create table `counters` (
+    `table_name` varchar(50) not null,
+    `group_by` varchar(100) not null,
+    `group_key` varchar(500) not null,
+    `n` bigint not null,
+    `updated_at` real not null,
+    primary key (`table_name`, `group_by`, `group_key`)
+) engine=innodb default charset=utf8;'''
+
+
+def group_name(columns):
+    return ','.join(columns) or '*'
+
+
+def column_value(cls, column, value):
+    ' value of column as stored: ids given as text are parsed by their IdField. '
+    if value is None or column not in cls.__ids__:
+        return value
+    return cls.__mappings__[column].parse(value)
+
+
+def group_key(cls, columns, values):
+    ' key of the group of values of columns, the same for an id given as text or as stored. '
+    values = [column_value(cls, c, v) for c, v in zip(columns, values)]
+    # binary(16)的id按hex记
+    return json.dumps(values, ensure_ascii=False, separators=(',', ':'),
+                      default=lambda v: v.hex() if isinstance(v, bytes) else str(v))
+
+
+def add_counts(cls, rows, sign, deltas):
+    ' add sign to the count of the group of each row (a dict with the counted columns) for every grouping. '
+    for row in rows:
+        for columns in cls.__counters__:
+            key = (group_name(columns), group_key(cls, columns, [row.get(c) for c in columns]))
+            deltas[key] = deltas.get(key, 0) + sign
+
+
+async def write_counts(cls, counts, exact=False):
+    ' add counts {(group_by, group_key): n} to the counter table, or set them when exact. '
+    now = time.time()
+    rows = [(cls.__table__, group_by, key, n, now) for (group_by, key), n in counts.items() if n or exact]
+    for chunk in chunk_rows(rows, lambda r: len(COUNTER_ROW) + estimate_args_size(r)):
+        sql = COUNTER_UPSERT.format(','.join([COUNTER_ROW] * len(chunk)), 'values(`n`)' if exact else '`n`+values(`n`)')
+        await execute(sql, [arg for row in chunk for arg in row])
+
+
+async def stored_groups(cls, pks):
+    ' the counted columns of the stored rows with primary keys pks, locked until the transaction ends. '
+    pk = cls.__primary_key__
+    columns = tuple([pk] + sorted(cls.__counted__))
+    rows = []
+    for i in range(0, len(pks), 1000):
+        chunk = pks[i:i + 1000]
+        sql = '{} where `{}` in ({}) for update'.format(select_sql(cls, columns), pk, create_args_string(len(chunk)))
+        rows.extend(await select(sql, chunk, coalesce=False))
+    return rows
+
+
+def count_moves(cls, old, objs, deltas):
+    ' move the counts of stored rows old to the groups of the updated objs. '
+    if not old:
+        return
+    pk = cls.__primary_key__
+    updated = {o.getvalue(pk): o for o in objs}
+    for row in old:
+        obj = updated.get(row[pk])
+        if obj is None:
+            continue
+        new = dict(row)
+        new.update((c, obj[c]) for c in cls.__counted__ if c in obj)
+        add_counts(cls, [row], -1, deltas)
+        add_counts(cls, [new], 1, deltas)
+
+
+@contextlib.asynccontextmanager
+async def counting(cls):
+    '''
+        run the writes of the block and the counter changes they add to the yielded dict in one transaction.
+        yields None for models without __counters__.
+    '''
+    if not cls.__counters__:
+        yield None
+        return
+    deltas = {}
+    async with transaction():
+        yield deltas
+        await write_counts(cls, deltas)
+    for key in deltas:
+        cls.__counter_cache__.invalidate(key)
 
 
 class ModelMetaclass(type):
@@ -149,6 +1024,7 @@ class ModelMetaclass(type):
         attrs['__table__'] = tableName
         attrs['__primary_key__'] = primaryKey
         attrs['__fields__'] = fields
+        attrs['__lazy__'] = [f for f in fields if mappings[f].lazy]
         # 构造默认的select，insert， update和delete语句
         attrs['__select__'] = 'select `{}`, {} from `{}`'.format(primaryKey, ','.join(escaped_fields), tableName)
         attrs['__insert__'] = 'insert into `{}` ({}, `{}`) values ({})'.format(tableName, ','.join(escaped_fields),
@@ -159,10 +1035,56 @@ class ModelMetaclass(type):
             mappings.get(f).name or f),
                                                                                                fields)), primaryKey)
         attrs['__delete__'] = 'delete from `{}` where `{}`=?'.format(tableName, primaryKey)
-        return type.__new__(cls, name, bases, attrs)
+        attrs['__row__'] = create_row_class(name, [primaryKey] + fields)
+        # snowflake超过2**53，二进制uuid不是文本，在JSON里都用字符串
+        attrs['__ids__'] = attrs['__row__'].__ids__ = frozenset(
+            k for k, v in mappings.items() if isinstance(v, IdField))
+        attrs['__find__'] = '{} where `{}`=?'.format(attrs['__select__'], primaryKey)
+        # 预先编译成驱动的参数格式
+        for key in ('__select__', '__insert__', '__update__', '__delete__', '__find__'):
+            compile_sql(attrs[key])
+        # 批量语句：insert的values部分和delete的in列表在调用时按行数展开
+        attrs['__insert_row__'] = '({})'.format(create_args_string(len(escaped_fields) + 1))
+        attrs['__delete_many__'] = 'delete from `{}` where `{}` in ({{}})'.format(tableName, primaryKey)
+        # __cache__ = dict(ttl=60, size=10000, max_bytes=...) 开启按主键的实体缓存
+        cache = attrs.get('__cache__', None)
+        attrs['__entity_cache__'] = LRUCache(**cache) if cache else None
+        # __counters__ = [(), 'user_id', ('a', 'b')] 按分组维护行数，()为全表
+        counters = tuple((c,) if isinstance(c, str) else tuple(c) for c in attrs.get('__counters__', ()))
+        for columns in counters:
+            for c in columns:
+                if c not in mappings:
+                    raise RuntimeError('Counter column not found: {}'.format(c))
+        attrs['__counters__'] = counters
+        attrs['__counted__'] = frozenset(c for columns in counters for c in columns)
+        attrs['__counter_cache__'] = LRUCache(ttl=10, size=10000) if counters else None
+        # 字段的index=True/'unique'和__indexes__ = ['a', ('b', 'c')]的多列索引 => (索引名, 列, 是否唯一)
+        declared = [((k,), v.index == 'unique') for k, v in mappings.items() if v.index and not v.primary_key]
+        declared += [((c,) if isinstance(c, str) else tuple(c), False) for c in attrs.get('__indexes__', ())]
+        indexes = []
+        for columns, unique in declared:
+            for c in columns:
+                if c not in mappings:
+                    raise RuntimeError('Index column not found: {}'.format(c))
+            columns = tuple(mappings[c].name or c for c in columns)
+            indexes.append((index_name(columns), columns, unique))
+        attrs['__indexes__'] = tuple(indexes)
+        model = type.__new__(cls, name, bases, attrs)
+        model.__ddl__ = create_table_sql(model)
+        models_by_table.setdefault(tableName, []).append(model)
+        return model
 
 
 class Model(dict, metaclass=ModelMetaclass):
+    __ids__ = frozenset()
+    __entity_cache__ = None
+    __counters__ = ()
+    __indexes__ = ()
+    __counted__ = frozenset()
+    __counter_cache__ = None
+    # 设为False则本模型的查询不参与合并，见select()
+    __coalesce__ = True
+
     def __init__(self, **kw):
         super(Model, self).__init__(**kw)
 
@@ -170,6 +1092,9 @@ class Model(dict, metaclass=ModelMetaclass):
         try:
             return self[key]
         except KeyError:
+            if key in self.__mappings__:
+                raise AttributeError(r"'{}' of '{}' is deferred, fetch it with load()".format(key,
+                                                                                          self.__class__.__name__))
             raise AttributeError(r"'Model' object has no attribute '{}'".format(key))
 
     def __setattr__(self, key, value):
@@ -184,77 +1109,413 @@ class Model(dict, metaclass=ModelMetaclass):
             field = self.__mappings__[key]
             if field.default is not None:
                 value = field.default() if callable(field.default) else field.default
-                logging.debug(str(datetime.now()) + 'using default value for {}: {}'.format(key, str(value)))
+                logging.debug('using default value for %s: %s', key, value)
                 setattr(self, key, value)
         return value
 
     @classmethod
-    async def find(cls, pk):
-        ' find object by primary key. '
-        rs = await select('{} where `{}`=?'.format(cls.__select__, cls.__primary_key__), [pk], 1)
+    def projection(cls, only=None, defer=None, lazy=True):
+        '''
+            columns of a projection as a tuple starting with the primary key, None when all columns are selected.
+            when neither only nor defer is given, lazy fields are deferred if lazy is True.
+        '''
+        if only is not None:
+            unknown = set(only) - set(cls.__fields__) - {cls.__primary_key__}
+            fields = [f for f in cls.__fields__ if f in only]
+        else:
+            if defer is None:
+                defer = cls.__lazy__ if lazy else ()
+            unknown = set(defer) - set(cls.__fields__)
+            fields = [f for f in cls.__fields__ if f not in defer]
+        if unknown:
+            raise ValueError('Invalid fields: {}'.format(', '.join(sorted(unknown))))
+        if len(fields) == len(cls.__fields__):
+            return None
+        return tuple([cls.__primary_key__] + fields)
+
+    @classmethod
+    async def find(cls, pk, only=None, defer=None):
+        '''
+            find object by primary key, only/defer select a subset of the columns.
+            inside batching() finds of all columns are collected into one find_many() per model.
+        '''
+        columns = cls.projection(only, defer, lazy=False)
+        pk = cls.__mappings__[cls.__primary_key__].parse(pk)
+        # 事务里读到的可能是未提交的数据，不进缓存，也不读缓存
+        cache = cls.__entity_cache__ if not in_transaction() else None
+        if cache is not None:
+            row = cache.get(pk)
+            if row is not None:
+                track_table(cls.__table__)
+                return cls(**row)
+        loader = current_loader()
+        if loader is not None and columns is None:
+            return (await loader.load(cls, pk))
+        if columns is None:
+            sql = cls.__find__
+        else:
+            sql = findall_sql(cls, '`{}`=?'.format(cls.__primary_key__), None, None, columns)
+        mark = write_clock.mark()
+        rs = await select(sql, [pk], 1, coalesce=cls.__coalesce__)
         if len(rs) == 0:
             return None
+        # 查询期间表被写过，读到的可能是旧行，不回填
+        if cache is not None and columns is None and write_clock.fresh(mark, (cls.__table__,)):
+            cache.put(pk, rs[0])
         return cls(**rs[0])
 
+    @classmethod
+    async def find_many(cls, pks, only=None, defer=None, chunk=1000):
+        '''
+            find objects by primary keys with one select ... where pk in (...) per chunk keys,
+            returned in the order of pks with None for keys that are not found.
+        '''
+        columns = cls.projection(only, defer, lazy=False)
+        pk = cls.__primary_key__
+        parse = cls.__mappings__[pk].parse
+        pks = [parse(key) for key in pks]
+        cache = cls.__entity_cache__ if columns is None and not in_transaction() else None
+        rows = {}
+        missing = []
+        for key in pks:
+            if key in rows:
+                continue
+            row = cache.get(key) if cache is not None else None
+            rows[key] = row
+            if row is None:
+                missing.append(key)
+        if len(missing) < len(rows):
+            track_table(cls.__table__)
+        for i in range(0, len(missing), chunk):
+            keys = missing[i:i + chunk]
+            sql = '{} where `{}` in ({})'.format(select_sql(cls, columns), pk, create_args_string(len(keys)))
+            mark = write_clock.mark()
+            rs = await select(sql, keys, coalesce=cls.__coalesce__)
+            fill = cache is not None and write_clock.fresh(mark, (cls.__table__,))
+            for r in rs:
+                rows[r[pk]] = r
+                if fill:
+                    cache.put(r[pk], r)
+        return [None if rows[key] is None else cls(**rows[key]) for key in pks]
+
+    @classmethod
+    def cachestats(cls):
+        ' hit/miss/eviction counters of the entity cache, None if caching is off. '
+        if cls.__entity_cache__ is None:
+            return None
+        return cls.__entity_cache__.stats()
+
+    @classmethod
+    def invalidate(cls, *pks):
+        if cls.__entity_cache__ is not None:
+            invalidate_entities(cls, pks)
+
     @classmethod
     async def findall(cls, where=None, args=None, **kw):
         '''
             find objects by where clause.
+            with compact=True rows are returned as the model's slot based __row__ objects.
+            only=[...] or defer=[...] select a subset of the columns, by default lazy fields are deferred;
+            deferred fields can be fetched later with load() or load_many().
         '''
-        sql = [cls.__select__]
-        if where:
-            sql.append('where')
-            sql.append(where)
-        if args is None:
-            args = []
-        orderBy = kw.get('orderBy', None)
-        if orderBy:
-            sql.append('order by')
-            sql.append(orderBy)
+        args = list(args) if args else []
         limit = kw.get('limit', None)
-        if limit is not None:
-            sql.append('limit')
-            if isinstance(limit, int):
-                sql.append('?')
-                args.append(limit)
-            elif isinstance(limit, tuple) and len(limit) == 2:
-                sql.append('?,?')
-                args.extend(limit)
-            else:
-                raise ValueError('Invalid limit value: {}'.format(str(limit)))
-        logging.info(str(datetime.now()) + ' {!s}.'.format(' '.join(sql)))
-        rs = await select(' '.join(sql), args)
+        if limit is None:
+            form = None
+        elif isinstance(limit, int):
+            form = 1
+            args.append(limit)
+        elif isinstance(limit, tuple) and len(limit) == 2:
+            form = 2
+            args.extend(limit)
+        else:
+            raise ValueError('Invalid limit value: {}'.format(str(limit)))
+        columns = cls.projection(kw.get('only', None), kw.get('defer', None))
+        sql = findall_sql(cls, where, kw.get('orderBy', None), form, columns)
+        if kw.get('compact', False):
+            row = projected_row_class(cls, columns)
+            return [row(*r) for r in await select(sql, args, raw=True, coalesce=cls.__coalesce__)]
+        rs = await select(sql, args, coalesce=cls.__coalesce__)
         return [cls(**r) for r in rs]
 
+    @classmethod
+    async def iterate(cls, where=None, args=None, batch=500, **kw):
+        '''
+            iterate objects by where clause without loading the whole result, see select_iter().
+            supports orderBy, compact, only and defer like findall().
+        '''
+        columns = cls.projection(kw.get('only', None), kw.get('defer', None))
+        sql = findall_sql(cls, where, kw.get('orderBy', None), None, columns)
+        if kw.get('compact', False):
+            row = projected_row_class(cls, columns)
+            async for r in select_iter(sql, args, batch, raw=True):
+                yield row(*r)
+        else:
+            async for r in select_iter(sql, args, batch):
+                yield cls(**r)
+
+    @classmethod
+    async def findpage(cls, where=None, args=None, order_by='created_at', after=None, before=None, size=20,
+                       desc=True, only=None, defer=None):
+        '''
+            find a page of objects by keyset pagination on (order_by, primary key).
+            after/before are cursors returned by a previous page, and the result is a dict of
+            items, next and previous, where next/previous are cursors or None at either end.
+            only/defer select columns like findall().
+        '''
+        if order_by not in cls.__mappings__:
+            raise ValueError('Invalid order_by field: {}'.format(order_by))
+        if only is not None and order_by not in only:
+            only = list(only) + [order_by]
+        columns = cls.projection(only, defer)
+        if after is not None and before is not None:
+            raise ValueError('Only one of after and before can be given.')
+        pk = cls.__primary_key__
+        # 向前翻页时反向排序，取回后再倒序
+        backward = before is not None
+        ascending = desc == backward
+        args = list(args) if args else []
+        cursor = after if after is not None else before
+        if cursor is not None:
+            value, key = decode_cursor(cursor)
+            try:
+                value, key = cls.__mappings__[order_by].parse(value), cls.__mappings__[pk].parse(key)
+            except (ValueError, TypeError):
+                raise ValueError('Invalid cursor: {}'.format(cursor))
+            args.extend([value, value, key])
+        args.append(size + 1)
+        rs = await select(findpage_sql(cls, where, order_by, ascending, cursor is not None, columns), args,
+                          coalesce=cls.__coalesce__)
+        more = len(rs) > size
+        items = [cls(**r) for r in rs[:size]]
+        if backward:
+            items.reverse()
+        first = encode_cursor(items[0][order_by], items[0][pk]) if items else None
+        last = encode_cursor(items[-1][order_by], items[-1][pk]) if items else None
+        if backward:
+            return dict(items=items, next=last, previous=first if more else None)
+        return dict(items=items, next=last if more else None, previous=first if after is not None else None)
+
+    @classmethod
+    async def count(cls, **group):
+        '''
+            number of rows in a grouping declared in __counters__, from the counter table instead of count(*):
+            Blog.count() for all blogs when () is declared, Comment.count(blog_id=...) for 'blog_id'.
+        '''
+        for columns in cls.__counters__:
+            if set(columns) == set(group):
+                break
+        else:
+            raise ValueError('No counter for {} by {}'.format(cls.__name__, group_name(sorted(group))))
+        key = (group_name(columns), group_key(cls, columns, [group[c] for c in columns]))
+        n = cls.__counter_cache__.get(key)
+        if n is not None:
+            track_table('counters')
+        else:
+            mark = write_clock.mark()
+            rs = await select('select `n` from `counters` where `table_name`=? and `group_by`=? and `group_key`=?',
+                              [cls.__table__, key[0], key[1]], 1)
+            n = int(rs[0]['n']) if rs else 0
+            if write_clock.fresh(mark, ('counters',)):
+                cls.__counter_cache__.put(key, n)
+        return n
+
+    @classmethod
+    async def reconcile(cls, batch=1000):
+        '''
+            rebuild the counters of the model from count(*) over batch groups at a time, and zero those of
+            groups that no longer have rows. each batch counts with a locking read and sets its counters in
+            one transaction on the primary: writes to its rows wait for the batch to commit and then add
+            their deltas to the exact counts, writes committed before are already in them.
+        '''
+        start = time.time()
+        for columns in cls.__counters__:
+            name = group_name(columns)
+            if not columns:
+                async with transaction():
+                    rs = await select('select count(*) `_num_` from `{}` lock in share mode'.format(cls.__table__), [])
+                    await write_counts(cls, {(name, group_key(cls, (), ())): rs[0]['_num_']}, exact=True)
+            last = None
+            while columns:
+                cols = ', '.join('`{}`'.format(c) for c in columns)
+                where = '' if last is None else 'where ({}) > ({})'.format(cols, create_args_string(len(columns)))
+                sql = 'select {0}, count(*) `_num_` from `{1}` {2} group by {0} order by {0} limit ? ' \
+                      'lock in share mode'.format(cols, cls.__table__, where)
+                async with transaction():
+                    rs = await select(sql, (last or []) + [batch])
+                    counts = {(name, group_key(cls, columns, [r[c] for c in columns])): r['_num_'] for r in rs}
+                    await write_counts(cls, counts, exact=True)
+                if len(rs) < batch:
+                    break
+                last = [rs[-1][c] for c in columns]
+            # 本次没有写到的分组已经没有行了，之后写入的行会更新updated_at
+            await execute('update `counters` set `n`=0 where `table_name`=? and `group_by`=? and `updated_at`<?',
+                          [cls.__table__, name, start])
+        if cls.__counter_cache__ is not None:
+            cls.__counter_cache__.clear()
+
     @classmethod
     async def findnumber(cls, selectField, where=None, args=None):
-        ' find number by select and where. '
-        sql = ['selevt {} _num_ from `{}`'.format(selectField, cls.__table__)]
+        ' find number by select and where, prefer count() for totals of declared groupings. '
+        sql = ['select {} _num_ from `{}`'.format(selectField, cls.__table__)]
         if where:
             sql.append('where')
             sql.append(where)
-        rs = await select(' '.join(sql), args, 1)
+        rs = await select(' '.join(sql), args, 1, coalesce=cls.__coalesce__)
         if len(rs) == 0:
             return None
         return rs[0]['_num_']
 
-    async def save(self):
+    def insertargs(self):
         args = list(map(self.getvalueordefault, self.__fields__))
         args.append(self.getvalueordefault(self.__primary_key__))
-        rows = await execute(self.__insert__, args)
+        return args
+
+    def loadedfields(self):
+        ' non primary key fields present in this object, deferred ones are left out of updates. '
+        return tuple(f for f in self.__fields__ if f in self)
+
+    def updateargs(self, fields):
+        args = list(map(self.getvalue, fields))
+        args.append(self.getvalue(self.__primary_key__))
+        return args
+
+    async def load(self, *names):
+        ' fetch deferred fields of this object, all missing fields when no names are given. '
+        await self.load_many([self], *names)
+
+    @classmethod
+    async def load_many(cls, objs, *names):
+        '''
+            fetch deferred fields of objects or compact rows with one select ... where pk in (...)
+            per 1000 objects, all fields missing from any object when no names are given.
+        '''
+        unknown = set(names) - set(cls.__fields__)
+        if unknown:
+            raise ValueError('Invalid fields: {}'.format(', '.join(sorted(unknown))))
+        names = names or [f for f in cls.__fields__ if any(f not in o for o in objs)]
+        pending = [o for o in objs if any(n not in o for n in names)]
+        if not pending:
+            return
+        pk = cls.__primary_key__
+        columns = tuple([pk] + [f for f in cls.__fields__ if f in names])
+        for i in range(0, len(pending), 1000):
+            chunk = pending[i:i + 1000]
+            sql = '{} where `{}` in ({})'.format(select_sql(cls, columns), pk, create_args_string(len(chunk)))
+            rows = {r[pk]: r for r in await select(sql, [o[pk] for o in chunk], coalesce=cls.__coalesce__)}
+            for o in chunk:
+                r = rows.get(o[pk])
+                if r is not None:
+                    for n in columns[1:]:
+                        setattr(o, n, r[n])
+
+    @classmethod
+    async def save_many(cls, objs, max_packet=None):
+        '''
+            insert objects with multi-row insert statements in one transaction.
+            return the affected rows of each chunk.
+        '''
+        head = cls.__insert__[:cls.__insert__.rindex(' values ')]
+        rows = [obj.insertargs() for obj in objs]
+        chunks = []
+        for chunk in chunk_rows(rows, lambda r: len(cls.__insert_row__) + estimate_args_size(r), max_packet):
+            sql = '{} values {}'.format(head, ','.join([cls.__insert_row__] * len(chunk)))
+            chunks.append([(sql, [arg for row in chunk for arg in row])])
+        if not chunks:
+            return []
+        async with counting(cls) as deltas:
+            affected = await execute_many(chunks)
+            if deltas is not None and sum(affected) == len(rows):
+                add_counts(cls, objs, 1, deltas)
+        notify_model('save', cls, objs)
+        if sum(affected) != len(rows):
+            logging.warning('failed to insert records: affected rows: {}'.format(affected))
+        return affected
+
+    @classmethod
+    async def update_many(cls, objs, max_packet=None):
+        '''
+            update objects by primary key on one connection in one transaction.
+            return the affected rows of each chunk.
+        '''
+        rows = []
+        for obj in objs:
+            fields = obj.loadedfields()
+            rows.append((update_sql(cls, fields), obj.updateargs(fields)))
+        chunks = list(chunk_rows(rows, lambda r: len(r[0]) + estimate_args_size(r[1]), max_packet))
+        if not chunks:
+            return []
+        async with counting(cls) as deltas:
+            moved = [o for o in objs if cls.__counted__.intersection(o)] if deltas is not None else []
+            old = await stored_groups(cls, [o.getvalue(cls.__primary_key__) for o in moved]) if moved else []
+            affected = await execute_many(chunks)
+            count_moves(cls, old, moved, deltas)
+        cls.invalidate(*[args[-1] for sql, args in rows])
+        notify_model('update', cls, objs)
+        if sum(affected) != len(rows):
+            logging.warning('failed to update by primary key: affected rows: {}'.format(affected))
+        return affected
+
+    @classmethod
+    async def remove_many(cls, objs, max_packet=None):
+        '''
+            remove objects with delete ... where pk in (...) statements in one transaction.
+            return the affected rows of each chunk.
+        '''
+        pks = [obj.getvalue(cls.__primary_key__) for obj in objs]
+        chunks = []
+        for chunk in chunk_rows(pks, lambda pk: 3 + estimate_args_size((pk,)), max_packet):
+            sql = cls.__delete_many__.format(create_args_string(len(chunk)))
+            chunks.append([(sql, chunk)])
+        if not chunks:
+            return []
+        async with counting(cls) as deltas:
+            old = await stored_groups(cls, pks) if deltas is not None else []
+            affected = await execute_many(chunks)
+            if deltas is not None:
+                add_counts(cls, old, -1, deltas)
+        cls.invalidate(*pks)
+        notify_model('remove', cls, objs)
+        if sum(affected) != len(pks):
+            logging.warning('failed to remove by primary key: affected rows: {}'.format(affected))
+        return affected
+
+    async def save(self):
+        args = self.insertargs()
+        async with counting(self.__class__) as deltas:
+            rows = await execute(self.__insert__, args)
+            if deltas is not None and rows == 1:
+                add_counts(self.__class__, [self], 1, deltas)
+        if rows == 1:
+            notify_model('save', self.__class__, [self])
         if rows != 1:
             logging.warning(str(datetime.now()) + ' failed to insert record: affected rows: {}'.format(rows))
 
     async def update(self):
-        args = list(map(self.getvalue, self.__fields__))
-        args.append(self.getValue(self.__primary_key__))
-        rows = await execute(self.__update__, args)
+        cls = self.__class__
+        fields = self.loadedfields()
+        args = self.updateargs(fields)
+        async with counting(cls) as deltas:
+            moved = deltas is not None and cls.__counted__.intersection(fields)
+            old = await stored_groups(cls, [args[-1]]) if moved else []
+            rows = await execute(update_sql(cls, fields), args)
+            count_moves(cls, old, [self], deltas)
+        self.invalidate(args[-1])
+        if rows == 1:
+            notify_model('update', cls, [self])
         if rows != 1:
             logging.warning('failed to update by primary key: affected rows: %s' % rows)
 
     async def remove(self):
         args = [self.getvalue(self.__primary_key__)]
-        rows = await execute(self.__delete__, args)
+        async with counting(self.__class__) as deltas:
+            old = await stored_groups(self.__class__, args) if deltas is not None else []
+            rows = await execute(self.__delete__, args)
+            if deltas is not None and rows == 1:
+                add_counts(self.__class__, old, -1, deltas)
+        self.invalidate(args[0])
+        if rows == 1:
+            notify_model('remove', self.__class__, [self])
         if rows != 1:
             logging.warning('failed to remove by primary key: affected rows: %s' % rows)
 
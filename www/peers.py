@@ -0,0 +1,69 @@
+'''
+    Cache invalidation across the workers of server.py.
+
+    Each worker binds a unix datagram socket in a directory made by the master. The tables a worker
+    writes are sent to the other workers, which drop what they cached from them as if they had
+    written them, see orm.written_elsewhere(). The entity, counter and page caches of a worker so
+    never serve rows another worker has changed, beyond the time a datagram takes.
+'''
+
+import os, socket, logging
+
+import orm
+
+
+class Peers(object):
+    '''
+    The socket of worker index out of count, in directory.
+    '''
+
+    def __init__(self, directory, index, count):
+        self.paths = [os.path.join(directory, '{}.sock'.format(i)) for i in range(count)]
+        self.index = index
+        self.receiving = False
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        # 重启的worker沿用原编号，先删掉上一个留下的
+        try:
+            os.unlink(self.paths[index])
+        except FileNotFoundError:
+            pass
+        self.sock.bind(self.paths[index])
+        self.sock.setblocking(False)
+
+    def start(self, loop):
+        loop.add_reader(self.sock.fileno(), self.receive)
+        orm.write_listeners.append(self.send)
+
+    def send(self, table):
+        ' write listener sending table to the other workers. '
+        if self.receiving:
+            return
+        data = table.encode('utf-8')
+        for i, path in enumerate(self.paths):
+            if i == self.index:
+                continue
+            try:
+                self.sock.sendto(data, path)
+            except (FileNotFoundError, ConnectionRefusedError):
+                # 还没启动或正在重启的worker，启动时缓存是空的
+                pass
+            except BlockingIOError:
+                logging.warning('peers: worker {} is not reading, dropped the write of {}'.format(i, table))
+
+    def receive(self):
+        self.receiving = True
+        try:
+            while True:
+                try:
+                    data = self.sock.recv(1024)
+                except BlockingIOError:
+                    break
+                orm.written_elsewhere(data.decode('utf-8'))
+        finally:
+            self.receiving = False
+
+    def close(self, loop):
+        loop.remove_reader(self.sock.fileno())
+        if self.send in orm.write_listeners:
+            orm.write_listeners.remove(self.send)
+        self.sock.close()
@@ -0,0 +1,236 @@
+'''
+    Routing of reads and writes across a primary and replica connection pools.
+'''
+
+import asyncio, logging, contextlib, contextvars, time, weakref
+
+import aiomysql
+
+from metrics import REGISTRY
+
+# 本次请求(task)写过主库后，后续读也走主库
+wrote_primary = contextvars.ContextVar('wrote_primary', default=False)
+
+checkout_seconds = REGISTRY.histogram('orm_pool_checkout_seconds', 'Time waiting for a pooled connection.')
+pool_size = REGISTRY.gauge('orm_pool_size', 'Open connections per pool.')
+pool_in_use = REGISTRY.gauge('orm_pool_in_use', 'Connections checked out per pool.')
+pool_free = REGISTRY.gauge('orm_pool_free', 'Idle connections per pool.')
+pool_max = REGISTRY.gauge('orm_pool_maxsize', 'Maximum connections per pool.')
+validations = REGISTRY.counter('orm_pool_validations_total', 'Idle connections pinged on checkout.')
+recycled = REGISTRY.counter('orm_pool_recycled_total', 'Connections closed for their age or idle time.')
+
+# 连接建立的时间(事件循环时钟)，按最大存活时间回收
+opened = weakref.WeakKeyDictionary()
+
+
+def opened_at(conn, now):
+    '''
+    When conn was opened, recorded the first time it is checked out. aiomysql sets last_usage when
+    it creates a connection and again only when a cursor is made, so until then it is the open time.
+    '''
+    return opened.setdefault(conn, getattr(conn, 'last_usage', None) or now)
+
+
+def idle_seconds(conn, now):
+    ' seconds since conn was last used, None for connections that do not track it. '
+    last = getattr(conn, 'last_usage', None)
+    return None if last is None else now - last
+
+
+@contextlib.asynccontextmanager
+async def checkout(name, pool, validate_idle=None):
+    '''
+    Get a connection from pool, recording the wait. A connection idle for more than validate_idle
+    seconds is pinged first, which reconnects it if the server dropped it.
+    '''
+    start = time.perf_counter()
+    async with pool.get() as conn:
+        checkout_seconds.observe(time.perf_counter() - start, pool=name)
+        now = asyncio.get_event_loop().time()
+        opened_at(conn, now)
+        if validate_idle is not None:
+            idle = idle_seconds(conn, now)
+            if idle is not None and idle > validate_idle:
+                validations.inc(pool=name)
+                await conn.ping()
+        yield conn
+
+
+async def warm(pool, size):
+    ' open up to size connections before serving, so the first requests do not pay the handshakes. '
+    size = min(size, getattr(pool, 'maxsize', size))
+    async with contextlib.AsyncExitStack() as stack:
+        for i in range(size):
+            conn = await stack.enter_async_context(pool.get())
+            opened_at(conn, asyncio.get_event_loop().time())
+
+
+async def recycle(name, pool, max_lifetime=None, max_idle=None):
+    '''
+    Close the idle connections of pool that are older than max_lifetime or unused for max_idle seconds.
+    Each idle connection is checked out once in turn, so busy ones are never touched.
+    '''
+    closed = 0
+    for i in range(getattr(pool, 'freesize', 0)):
+        async with pool.get() as conn:
+            now = asyncio.get_event_loop().time()
+            born = opened_at(conn, now)
+            idle = idle_seconds(conn, now)
+            if (max_lifetime and now - born > max_lifetime) or (max_idle and idle is not None and idle > max_idle):
+                # 关闭的连接归还时会被连接池丢弃
+                conn.close()
+                closed += 1
+    if closed:
+        recycled.inc(closed, pool=name)
+        logging.info('recycled {} connections of {}'.format(closed, name))
+    return closed
+
+
+class Replica(object):
+    '''
+    A replica pool with its outstanding request count and health.
+    '''
+
+    def __init__(self, name, pool):
+        self.name = name
+        self.pool = pool
+        self.outstanding = 0
+        self.healthy = True
+
+
+class PoolRouter(object):
+    '''
+    Route reads to the healthy replica with the least outstanding requests and writes to the primary.
+    Pools only need a get() returning an async context manager of a connection, so local stand-ins work.
+    '''
+
+    def __init__(self, primary, replicas=(), sticky=True, warm_size=0, validate_idle=None, max_lifetime=None,
+                 max_idle=None):
+        self.primary = primary
+        self.replicas = [Replica('replica{}'.format(i), pool) for i, pool in enumerate(replicas)]
+        self.sticky = sticky
+        self.warm_size = warm_size
+        self.validate_idle = validate_idle
+        self.max_lifetime = max_lifetime
+        self.max_idle = max_idle
+        self._tasks = []
+        pool_size.collect = lambda: self.poolstats(lambda p: p.size)
+        pool_in_use.collect = lambda: self.poolstats(lambda p: p.size - p.freesize)
+        pool_free.collect = lambda: self.poolstats(lambda p: p.freesize)
+        pool_max.collect = lambda: self.poolstats(lambda p: p.maxsize)
+
+    def pools(self):
+        return [self.primary] + [r.pool for r in self.replicas]
+
+    def named_pools(self):
+        return [('primary', self.primary)] + [(r.name, r.pool) for r in self.replicas]
+
+    def poolstats(self, stat):
+        ' gauge values of stat(pool) by pool name, skipping stand-in pools without the counters. '
+        values = {}
+        for name, pool in self.named_pools():
+            try:
+                values[(('pool', name),)] = stat(pool)
+            except AttributeError:
+                pass
+        return values
+
+    def reader(self):
+        ' the replica to read from, None for the primary. '
+        if not self.replicas or (self.sticky and wrote_primary.get()):
+            return None
+        healthy = [r for r in self.replicas if r.healthy]
+        if not healthy:
+            return None
+        return min(healthy, key=lambda r: r.outstanding)
+
+    def wrote(self):
+        ' mark the current request as having written, for read-your-writes. '
+        if self.sticky:
+            wrote_primary.set(True)
+
+    @contextlib.asynccontextmanager
+    async def connection(self, read=False):
+        replica = self.reader() if read else None
+        if replica is None:
+            async with checkout('primary', self.primary, self.validate_idle) as conn:
+                yield conn
+            return
+        replica.outstanding += 1
+        try:
+            async with checkout(replica.name, replica.pool, self.validate_idle) as conn:
+                yield conn
+        finally:
+            replica.outstanding -= 1
+
+    async def run(self, fn, read=False):
+        '''
+        Run fn(conn) on a routed connection. A read failing with a connection error on a replica
+        marks it unhealthy and is retried on the primary.
+        '''
+        replica = self.reader() if read else None
+        if replica is None:
+            async with checkout('primary', self.primary, self.validate_idle) as conn:
+                return (await fn(conn))
+        replica.outstanding += 1
+        try:
+            async with checkout(replica.name, replica.pool, self.validate_idle) as conn:
+                return (await fn(conn))
+        except aiomysql.OperationalError as e:
+            logging.warning('replica {} failed, reading from primary: {!s}'.format(replica.name, e))
+            replica.healthy = False
+        finally:
+            replica.outstanding -= 1
+        async with checkout('primary', self.primary, self.validate_idle) as conn:
+            return (await fn(conn))
+
+    async def check(self):
+        for replica in self.replicas:
+            try:
+                async with replica.pool.get() as conn:
+                    opened_at(conn, asyncio.get_event_loop().time())
+                    await conn.ping()
+                if not replica.healthy:
+                    logging.info('replica {} is healthy again'.format(replica.name))
+                replica.healthy = True
+            except Exception as e:
+                if replica.healthy:
+                    logging.warning('replica {} failed health check: {!s}'.format(replica.name, e))
+                replica.healthy = False
+
+    async def warm(self):
+        for name, pool in self.named_pools():
+            await warm(pool, self.warm_size)
+
+    async def maintain(self):
+        ' recycle old and idle connections, then open fresh ones up to the warm size again. '
+        for name, pool in self.named_pools():
+            if await recycle(name, pool, self.max_lifetime, self.max_idle):
+                await warm(pool, self.warm_size)
+
+    def start(self, loop, interval=5, recycle_interval=60):
+        '''
+        In the background, check replica health every interval seconds and maintain the pools
+        every recycle_interval seconds.
+        '''
+
+        async def every(seconds, fn):
+            while True:
+                await asyncio.sleep(seconds)
+                try:
+                    await fn()
+                except Exception as e:
+                    logging.warning('pool maintenance failed: {!s}'.format(e))
+
+        if self.replicas:
+            self._tasks.append(loop.create_task(every(interval, self.check)))
+        if self.max_lifetime or self.max_idle:
+            self._tasks.append(loop.create_task(every(recycle_interval, self.maintain)))
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        for pool in self.pools():
+            pool.close()
+            await pool.wait_closed()
@@ -0,0 +1,31 @@
+'''
+    Rebuild the counters of models with __counters__ from count(*), run as: python reconcile.py [Model ...]
+'''
+
+import asyncio, sys, time, logging
+
+import orm
+import models
+from config import configs
+
+
+async def reconcile(loop, names, batch=1000):
+    await orm.create_pool(loop, host=configs.db.host, port=configs.db.port, user=configs.db.user,
+                          password=configs.db.password, db=configs.db.database)
+    try:
+        for name in names:
+            cls = getattr(models, name)
+            start = time.perf_counter()
+            await cls.reconcile(batch)
+            logging.info('reconciled {} counters in {:.3f}s'.format(name, time.perf_counter() - start))
+    finally:
+        await orm.destroy_pool()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    counted = [name for name, cls in vars(models).items()
+               if isinstance(cls, orm.ModelMetaclass) and cls.__counters__]
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(reconcile(loop, sys.argv[1:] or counted))
+    loop.close()
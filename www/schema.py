@@ -0,0 +1,114 @@
+'''
+    Schema generated from the models, run as:
+
+        python schema.py          print the create table statements of all models
+        python schema.py diff     print the statements migrating the configured database to the models
+
+    Columns and indexes the models do not declare are never dropped, the statements are printed
+    commented out for review.
+'''
+
+import asyncio, re, sys, logging
+
+import orm
+import models
+from config import configs
+
+# 模型里的写法 => information_schema.columns里的写法
+TYPE_ALIASES = {'bool': 'tinyint(1)', 'boolean': 'tinyint(1)', 'real': 'double', 'integer': 'int'}
+# MySQL 5.7显示整数的宽度，8.0不显示
+INT_WIDTH = re.compile(r'^((?:small|medium|big)?int)\(\d+\)')
+
+
+def all_models():
+    return [cls for cls in vars(models).values() if isinstance(cls, orm.ModelMetaclass) and cls is not orm.Model]
+
+
+def normalize_type(column_type):
+    column_type = column_type.lower().strip()
+    column_type = TYPE_ALIASES.get(column_type, column_type)
+    return INT_WIDTH.sub(r'\1', column_type)
+
+
+def create_sql():
+    return '\n\n'.join([cls.__ddl__ for cls in all_models()] + [orm.COUNTER_TABLE])
+
+
+async def live_schema():
+    '''
+    {table: ({column: (type, nullable)}, {index: (columns, unique)})} of the configured database.
+    every column is aliased, MySQL 8.0 returns information_schema column names in upper case.
+    '''
+    tables = {}
+    rs = await orm.select('select `table_name` `t`, `column_name` `c`, `column_type` `type`, `is_nullable` `nullable` '
+                          'from information_schema.columns where `table_schema`=database() '
+                          'order by `table_name`, `ordinal_position`', [], coalesce=False)
+    for r in rs:
+        tables.setdefault(r['t'], ({}, {}))[0][r['c']] = (normalize_type(r['type']), r['nullable'] == 'YES')
+    rs = await orm.select('select `table_name` `t`, `index_name` `i`, `column_name` `c`, `non_unique` `nu` '
+                          'from information_schema.statistics where `table_schema`=database() '
+                          'order by `table_name`, `index_name`, `seq_in_index`', [], coalesce=False)
+    for r in rs:
+        columns, unique = tables[r['t']][1].get(r['i'], ((), not int(r['nu'])))
+        tables[r['t']][1][r['i']] = (columns + (r['c'],), unique)
+    return tables
+
+
+def diff(cls, live):
+    ' statements turning the live table of cls, None when missing, into the declared one. '
+    table = cls.__table__
+    if live is None:
+        return [cls.__ddl__]
+    columns, indexes = live
+    sql = []
+    declared = [(f.name or k, f) for k, f in cls.__mappings__.items()]
+    for column, field in declared:
+        if column not in columns:
+            sql.append('alter table `{}` add column {};'.format(table, orm.column_ddl(column, field)))
+        elif isinstance(field, orm.IdField) and field.kind != 'legacy' and columns[column][0].startswith('varchar'):
+            sql.append('-- `{}`.`{}` holds legacy ids, convert it with migrate_ids.py'.format(table, column))
+        elif columns[column] != (normalize_type(field.column_type), False):
+            sql.append('alter table `{}` modify column {};'.format(table, orm.column_ddl(column, field)))
+    names = {column for column, field in declared}
+    for column in columns:
+        if column not in names:
+            sql.append('-- alter table `{}` drop column `{}`;'.format(table, column))
+    primary = ((cls.__mappings__[cls.__primary_key__].name or cls.__primary_key__),)
+    if indexes.get('PRIMARY', (None,))[0] != primary:
+        sql.append('alter table `{}` {}add primary key (`{}`);'.format(
+            table, 'drop primary key, ' if 'PRIMARY' in indexes else '', primary[0]))
+    wanted = {name: (columns, unique) for name, columns, unique in cls.__indexes__}
+    for name, (columns, unique) in wanted.items():
+        key = '{}key `{}` ({})'.format('unique ' if unique else '', name, ', '.join('`{}`'.format(c) for c in columns))
+        if name not in indexes:
+            sql.append('alter table `{}` add {};'.format(table, key))
+        elif indexes[name] != (columns, unique):
+            sql.append('alter table `{}` drop key `{}`, add {};'.format(table, name, key))
+    for name in indexes:
+        if name != 'PRIMARY' and name not in wanted:
+            sql.append('-- alter table `{}` drop key `{}`;'.format(table, name))
+    return sql
+
+
+async def migrate_sql(loop):
+    await orm.create_pool(loop, host=configs.db.host, port=configs.db.port, user=configs.db.user,
+                          password=configs.db.password, db=configs.db.database)
+    try:
+        tables = await live_schema()
+    finally:
+        await orm.destroy_pool()
+    sql = [] if 'counters' in tables else [orm.COUNTER_TABLE]
+    for cls in all_models():
+        sql.extend(diff(cls, tables.get(cls.__table__)))
+    return sql
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    if sys.argv[1:] == ['diff']:
+        loop = asyncio.get_event_loop()
+        statements = loop.run_until_complete(migrate_sql(loop))
+        loop.close()
+        print('\n'.join(statements) if statements else '-- the database matches the models')
+    else:
+        print(create_sql())
@@ -0,0 +1,547 @@
+'''
+    In-process full-text search: an inverted index with CJK bigrams, ranked by BM25.
+
+    The index is a memory-mapped segment written by save() plus an in-memory layer for documents
+    added or changed since, fed by orm.model_listeners. The workers of server.py share one index
+    through SharedIndex.
+'''
+
+import os, re, json, math, mmap, time, fcntl, heapq, struct, asyncio, logging, operator
+from array import array
+from collections import Counter
+
+import orm
+from config import configs
+from models import Blog, Comment
+
+# 要索引的模型和字段权重
+SOURCES = {
+    Blog: dict(name=3, summary=2, content=1),
+    Comment: dict(content=1),
+}
+
+MAGIC = b'BSI2'
+# 魔数、文档JSON的字节数、词数、词表的字节数
+HEADER = struct.Struct('<4sQQQ')
+# 小写后的英文数字词，或中日韩文字的连续片段
+WORD = re.compile(r'[0-9a-z]+|[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]+')
+
+
+def tokenize(text):
+    ' words of latin text, and overlapping bigrams of CJK text. '
+    tokens = []
+    for m in WORD.finditer(text.lower()):
+        word = m.group()
+        if word[0] < '\u3040' or len(word) == 1:
+            tokens.append(word)
+        else:
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+    return tokens
+
+
+def docid(pk):
+    ' primary key as stored in the index: binary uuids as hex, which Model.find() parses back. '
+    return pk.hex() if isinstance(pk, bytes) else pk
+
+
+class Segment(object):
+    '''
+    Postings read from a file written by write_segment(): a JSON list of the documents, a table of
+    (term offset, term length, postings offset, document count) as uint32 sorted by term, the utf-8
+    terms, then per term its document ids and term frequencies as uint32 arrays. Terms are found by
+    binary search on the mapped table, so opening a segment reads only the documents.
+    '''
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[:len(MAGIC)] != MAGIC:
+            self.mm.close()
+            self.file.close()
+            raise ValueError('not a search index: {}'.format(path))
+        magic, size, count, keys = HEADER.unpack_from(self.mm)
+        self.view = memoryview(self.mm)
+        self.docs = [tuple(d) for d in json.loads(self.mm[HEADER.size:HEADER.size + size].decode('utf-8'))]
+        start = HEADER.size + size
+        self.count = count
+        self.table = self.view[start:start + 16 * count].cast('I')
+        self.keys = start + 16 * count
+        self.base = self.keys + keys
+
+    def key(self, i):
+        ' utf-8 bytes of the i-th term. '
+        start = self.keys + self.table[4 * i]
+        return self.mm[start:start + self.table[4 * i + 1]]
+
+    def find(self, term):
+        ' position of term in the table, None when missing. '
+        key = term.encode('utf-8')
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            k = self.key(mid)
+            if k < key:
+                lo = mid + 1
+            elif k > key:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def entry(self, i):
+        ' (document ids, term frequencies) of the i-th term. '
+        start, n = self.base + self.table[4 * i + 2], self.table[4 * i + 3]
+        # 直接在映射的内存上读，不复制
+        view = self.view[start:start + 8 * n].cast('I')
+        return view[:n], view[n:]
+
+    def postings(self, term):
+        ' (document ids, term frequencies) of term. '
+        i = self.find(term)
+        return ((), ()) if i is None else self.entry(i)
+
+    def items(self):
+        ' (term, postings) of every term in order, the postings being the bytes of its ids then frequencies. '
+        mm, keys, base, table = self.mm, self.keys, self.base, self.table.tolist()
+        for i in range(0, len(table), 4):
+            key, size, offset, n = table[i:i + 4]
+            yield mm[keys + key:keys + key + size].decode('utf-8'), mm[base + offset:base + offset + 8 * n]
+
+    def close(self):
+        self.table.release()
+        self.view.release()
+        self.mm.close()
+        self.file.close()
+
+
+def file_stamp(path):
+    ' identity of the file at path, changing when os.replace() puts another there, None if missing. '
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_mtime_ns
+
+
+def write_segment(path, docs, postings):
+    '''
+    write docs [(kind, pk, length)] and postings {term: (ids, tfs)} atomically to path. The postings
+    of a term can also be the bytes read by Segment.items(), copied as they are.
+    '''
+    table, keys, body = array('I'), bytearray(), array('I')
+    for term in sorted(postings):
+        key = term.encode('utf-8')
+        value = postings[term]
+        if isinstance(value, bytes):
+            table.extend((len(keys), len(key), 4 * len(body), len(value) // 8))
+            body.frombytes(value)
+        else:
+            ids, tfs = value
+            table.extend((len(keys), len(key), 4 * len(body), len(ids)))
+            body.extend(ids)
+            body.extend(tfs)
+        keys += key
+    meta = json.dumps(docs, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(meta), len(postings), len(keys)))
+        f.write(meta)
+        table.tofile(f)
+        f.write(keys)
+        body.tofile(f)
+    os.replace(tmp, path)
+
+
+def write_index(path, segment, docs, deleted, memory):
+    '''
+    Merge the postings of segment less the deleted documents with those of memory {term: {doc: tf}}
+    into a new segment at path, renumbering the documents left in docs. Touches nothing else of the
+    index, so it can run in a thread. Returns the number of documents and terms.
+    '''
+    live = [doc for doc, d in enumerate(docs) if d is not None]
+    # 没有删除过文档时编号不变，直接拷贝倒排表
+    renumber = None
+    if len(live) != len(docs):
+        renumber = [0] * len(docs)
+        for i, doc in enumerate(live):
+            renumber[doc] = i
+    postings = {}
+    if segment is not None:
+        for term, block in segment.items():
+            added = memory.get(term)
+            if renumber is None and not added:
+                postings[term] = block
+                continue
+            values = array('I')
+            values.frombytes(block)
+            ids, tfs = values[:len(values) // 2], values[len(values) // 2:]
+            pairs = [(doc, tf) for doc, tf in zip(ids, tfs) if doc not in deleted]
+            if added:
+                pairs.extend(added.items())
+            if pairs:
+                docs_of = [doc for doc, tf in pairs]
+                postings[term] = (docs_of if renumber is None else [renumber[doc] for doc in docs_of],
+                                  [tf for doc, tf in pairs])
+    for term, added in memory.items():
+        if term not in postings:
+            postings[term] = (list(added) if renumber is None else [renumber[doc] for doc in added],
+                              list(added.values()))
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    write_segment(path, [docs[doc] for doc in live], postings)
+    return len(live), len(postings)
+
+
+async def in_thread(fn, *args):
+    '''
+    Run fn(*args) in the default executor. A cancelled caller still waits for fn to return, so the
+    files and locks it holds are not released under the thread.
+    '''
+    future = asyncio.get_event_loop().run_in_executor(None, fn, *args)
+    try:
+        return (await asyncio.shield(future))
+    except asyncio.CancelledError:
+        await future
+        raise
+
+
+async def flock(f, operation, delay=0.01, max_delay=0.5):
+    ' take the flock operation on f without blocking the event loop, retrying while another process holds it. '
+    while True:
+        try:
+            fcntl.flock(f, operation | fcntl.LOCK_NB)
+            return
+        except BlockingIOError:
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, max_delay)
+
+
+class SearchIndex(object):
+    '''
+    Documents are (kind, pk) pairs, kind being the table name. Documents of the segment are
+    numbered first; added ones get new numbers and replaced or removed segment documents are
+    masked until the next save() merges everything into a new segment.
+    '''
+
+    def __init__(self, path=None, k1=1.2, b=0.75):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self.segment = None
+        self.load()
+
+    def load(self):
+        if self.segment is not None:
+            self.segment.close()
+        try:
+            self.segment = Segment(self.path) if self.path and os.path.exists(self.path) else None
+        except ValueError as e:
+            # 旧格式的索引当作没有，重新建立
+            logging.warning('search index ignored: {!s}'.format(e))
+            self.segment = None
+        # 文档号 => (kind, pk, length)，删除的为None
+        self.docs = list(self.segment.docs) if self.segment is not None else []
+        self.ids = {(kind, pk): i for i, (kind, pk, length) in enumerate(self.docs)}
+        self.base_count = len(self.docs)
+        self.deleted = set()
+        # 内存层：term => {文档号: tf}，以及各文档的词频用于删除
+        self.memory = {}
+        self.terms = {}
+        self.total = sum(d[2] for d in self.docs)
+        self.dirty = False
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, kind, pk, fields, weights=None):
+        ' index or re-index a document from {field: text}, each token counted weights[field] times. '
+        pk = docid(pk)
+        self.remove(kind, pk)
+        tf = Counter()
+        for field, text in fields.items():
+            weight = weights.get(field, 1) if weights else 1
+            for token in tokenize(text or ''):
+                tf[token] += weight
+        length = sum(tf.values())
+        doc = len(self.docs)
+        self.docs.append((kind, pk, length))
+        self.ids[(kind, pk)] = doc
+        for term, n in tf.items():
+            self.memory.setdefault(term, {})[doc] = n
+        self.terms[doc] = tf
+        self.total += length
+        self.dirty = True
+
+    def remove(self, kind, pk):
+        doc = self.ids.pop((kind, docid(pk)), None)
+        if doc is None:
+            return
+        self.total -= self.docs[doc][2]
+        self.docs[doc] = None
+        self.dirty = True
+        if doc < self.base_count:
+            self.deleted.add(doc)
+            return
+        for term in self.terms.pop(doc):
+            postings = self.memory[term]
+            del postings[doc]
+            if not postings:
+                del self.memory[term]
+
+    def postings(self, term):
+        ' [(document, tf)] of term over both layers, without removed documents. '
+        result = []
+        if self.segment is not None:
+            ids, tfs = self.segment.postings(term)
+            deleted = self.deleted
+            result = [(doc, tf) for doc, tf in zip(ids, tfs) if doc not in deleted] if deleted else list(zip(ids, tfs))
+        result.extend(self.memory.get(term, {}).items())
+        return result
+
+    def search(self, query, kind=None, limit=20):
+        ' [(kind, pk, score)] of the best limit documents for query by BM25. '
+        n = len(self.ids)
+        terms = set(tokenize(query))
+        if not terms or not n:
+            return []
+        k1, b, avgdl = self.k1, self.b, self.total / n
+        docs = self.docs
+        scores = {}
+        for term in terms:
+            postings = self.postings(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc, tf in postings:
+                length = docs[doc][2]
+                if kind is not None and docs[doc][0] != kind:
+                    continue
+                scores[doc] = scores.get(doc, 0.0) + idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * length / avgdl))
+        best = heapq.nlargest(limit, scores.items(), key=operator.itemgetter(1))
+        return [(docs[doc][0], docs[doc][1], score) for doc, score in best]
+
+    def save(self):
+        ' merge both layers into a new segment file and reopen it. '
+        if not self.path:
+            return
+        docs, terms = write_index(self.path, self.segment, self.docs, self.deleted, self.memory)
+        self.load()
+        logging.info('search index saved: {} documents, {} terms'.format(docs, terms))
+
+    def close(self):
+        if self.dirty:
+            self.save()
+        if self.segment is not None:
+            self.segment.close()
+            self.segment = None
+
+    async def build(self, sources=SOURCES):
+        ' index every row of the source models, reading them with Model.iterate(). '
+        for cls, weights in sources.items():
+            async for obj in cls.iterate(only=list(weights)):
+                self.add(cls.__table__, obj[cls.__primary_key__], {f: obj.get(f) for f in weights}, weights)
+
+    async def refresh(self, cls, pk):
+        weights = SOURCES[cls]
+        # 只取索引的列，也不经过请求的Loader
+        obj = await cls.find(pk, only=list(weights))
+        self.change(cls.__table__, pk, None if obj is None else {f: obj.get(f) for f in weights}, weights)
+
+    def change(self, kind, pk, fields=None, weights=None):
+        ' add the document when fields are given, else remove it. '
+        if fields is None:
+            self.remove(kind, pk)
+        else:
+            self.add(kind, pk, fields, weights)
+
+    def on_write(self, event, cls, objs):
+        ' orm model listener keeping the index in step with save(), update() and remove(). '
+        weights = SOURCES.get(cls)
+        if weights is None:
+            return
+        for obj in objs:
+            # 请求里的id可能是文本，按字段解析成和build()读到的一样
+            pk = cls.__mappings__[cls.__primary_key__].parse(obj.getvalue(cls.__primary_key__))
+            if event == 'remove':
+                self.change(cls.__table__, pk)
+            elif all(f in obj for f in weights):
+                self.change(cls.__table__, pk, {f: obj[f] for f in weights}, weights)
+            else:
+                # 部分字段的更新，其余字段从数据库读
+                asyncio.ensure_future(self.refresh(cls, pk))
+
+
+class SharedIndex(SearchIndex):
+    '''
+    An index at path kept by every worker of server.py. Changes are appended to the journal
+    path + '.log' and every worker applies all of them from there, its own included, in journal order.
+    Only the worker holding the lock on path + '.lock' saves: it applies the rest of the journal,
+    writes the segment and empties the journal in one step under the journal lock, and the others
+    reload the segment when they find it replaced. When that worker exits another one takes over.
+    sync(), save() and close() are coroutines: the files are read and written in a thread and the
+    locks are taken without blocking, so serving goes on meanwhile.
+    '''
+
+    def __init__(self, path, k1=1.2, b=0.75):
+        self.journal = path + '.log'
+        self.owner = None
+        self.offset = 0
+        self.stamp = None
+        # 还没写进日志的修改
+        self.pending = []
+        # 同一时间只有一个sync()或save()在读写日志
+        self.busy = asyncio.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        super().__init__(path, k1, b)
+
+    def load(self):
+        super().load()
+        # 段文件和日志在同一把锁下替换和清空，新段之后从日志开头读
+        self.stamp = file_stamp(self.path)
+        self.offset = 0
+
+    def acquire(self):
+        ' whether this process saves the segment, taking the lock when no other process holds it. '
+        if self.owner is None:
+            f = open(self.path + '.lock', 'ab')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                f.close()
+                return False
+            self.owner = f
+        return True
+
+    def change(self, kind, pk, fields=None, weights=None):
+        super().change(kind, pk, fields, weights)
+        line = json.dumps(dict(kind=kind, pk=docid(pk), fields=fields, weights=weights), ensure_ascii=False)
+        self.pending.append(line.encode('utf-8') + b'\n')
+
+    def apply(self, data):
+        for line in data.splitlines():
+            r = json.loads(line.decode('utf-8'))
+            SearchIndex.change(self, r['kind'], r['pk'], r['fields'], r['weights'])
+
+    def exchange(self, f, lines, offset):
+        '''
+        In a thread, with the journal lock held on f: append lines, then return the stamp of the segment
+        and the journal from offset, from the start when the segment was replaced.
+        '''
+        if lines:
+            f.write(b''.join(lines))
+            f.flush()
+        stamp = file_stamp(self.path)
+        f.seek(offset if stamp == self.stamp else 0)
+        return stamp, f.read()
+
+    async def replay(self, f, lines):
+        ' append lines to the journal and apply the changes of all workers, f holding the journal lock. '
+        stamp, data = await in_thread(self.exchange, f, lines, self.offset)
+        if stamp != self.stamp:
+            self.load()
+        self.offset += len(data)
+        self.apply(data)
+
+    async def sync(self):
+        ' catch up with the changes of all workers. '
+        async with self.busy:
+            lines, self.pending = self.pending, []
+            with open(self.journal, 'a+b') as f:
+                # 有要写的修改才要排他锁
+                await flock(f, fcntl.LOCK_EX if lines else fcntl.LOCK_SH)
+                await self.replay(f, lines)
+
+    def write(self, f, segment, docs, deleted, memory):
+        ' in a thread: write the new segment and empty the journal f, whose changes it holds. '
+        counts = write_index(self.path, segment, docs, deleted, memory)
+        f.truncate(0)
+        return counts
+
+    async def save(self):
+        if not self.acquire():
+            return
+        async with self.busy:
+            lines, self.pending = self.pending, []
+            with open(self.journal, 'a+b') as f:
+                await flock(f, fcntl.LOCK_EX)
+                await self.replay(f, lines)
+                # 写文件期间事件循环里的修改只进内存层和pending，不动这里交给线程的部分
+                memory = {term: dict(postings) for term, postings in self.memory.items()}
+                docs, terms = await in_thread(self.write, f, self.segment, list(self.docs), set(self.deleted), memory)
+                self.load()
+        # 写文件期间的修改不在新段里，还没进日志，重新应用
+        self.apply(b''.join(self.pending))
+        logging.info('search index saved: {} documents, {} terms'.format(docs, terms))
+
+    async def close(self):
+        if self.dirty or self.pending:
+            await self.save()
+        if self.segment is not None:
+            self.segment.close()
+            self.segment = None
+        if self.owner is not None:
+            self.owner.close()
+            self.owner = None
+
+
+def build_index(path):
+    '''
+    Build the index at path from the database unless there is one, in a new event loop with its own
+    connection pool. server.py calls it before forking, so the workers all open the same segment.
+    '''
+    index = SearchIndex(path)
+    if index.segment is not None:
+        index.close()
+        return
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(orm.create_pool(loop=loop, host=configs.db.host, port=configs.db.port,
+                                                user=configs.db.user, password=configs.db.password,
+                                                db=configs.db.database, minsize=1, maxsize=1))
+        loop.run_until_complete(index.build())
+        index.close()
+        loop.run_until_complete(orm.destroy_pool())
+    finally:
+        loop.close()
+
+
+async def init_search(app, path=None, save_interval=300, sync_interval=1):
+    '''
+    Open the index at path, building it from the database when there is none, keep it updated from
+    model writes and save it every save_interval seconds when changed. With a path the index is a
+    SharedIndex, synced with the other workers every sync_interval seconds. Stored as app['__search__'].
+    '''
+    index = SharedIndex(path) if path else SearchIndex()
+    if index.segment is None:
+        # server.py在fork之前已经建好，单进程运行时在这里建
+        await index.build()
+        if path:
+            await index.save()
+    orm.model_listeners.append(index.on_write)
+    app['__search__'] = index
+
+    async def saver():
+        saved = time.monotonic()
+        while True:
+            await asyncio.sleep(sync_interval)
+            await index.sync()
+            if index.dirty and time.monotonic() - saved >= save_interval:
+                await index.save()
+                saved = time.monotonic()
+
+    if path:
+        app['__search_saver__'] = asyncio.ensure_future(saver())
+    logging.info('search index: {} documents'.format(len(index)))
+    return index
+
+
+async def close_search(app):
+    ' stop the saver and save what changed since the last save. '
+    index = app['__search__']
+    saver = app.get('__search_saver__')
+    if saver is not None:
+        saver.cancel()
+        await asyncio.gather(saver, return_exceptions=True)
+    if isinstance(index, SharedIndex):
+        await index.close()
+    else:
+        index.close()
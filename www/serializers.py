@@ -0,0 +1,134 @@
+'''
+    JSON encoding of handler results to bytes, with orjson when it is installed.
+'''
+
+import json, base64, decimal, logging
+from datetime import date, datetime, time
+
+import ids
+import orm
+from apis import APIError
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def model_dict(o):
+    ' a Model or Row as a plain dict, with its id columns as strings. '
+    d = dict(o) if isinstance(o, dict) else o.todict()
+    for k in o.__ids__:
+        v = d.get(k)
+        if v is not None:
+            d[k] = ids.text(v)
+    return d
+
+
+def plain(obj):
+    ' obj with the Models in its dicts and lists replaced by model_dict(), for encoders without subclass hooks. '
+    if isinstance(obj, orm.Model):
+        return model_dict(obj)
+    if isinstance(obj, dict):
+        return {k: plain(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [plain(v) for v in obj]
+    return obj
+
+
+def default(o):
+    ' encode the types json does not know. '
+    if isinstance(o, (orm.Model, orm.Row)):
+        return model_dict(o)
+    if isinstance(o, APIError):
+        return dict(error=o.error, data=o.data, message=o.message)
+    if isinstance(o, (datetime, date, time)):
+        return o.isoformat()
+    if isinstance(o, decimal.Decimal):
+        return str(o)
+    if isinstance(o, (set, frozenset)):
+        return list(o)
+    if isinstance(o, bytes):
+        return base64.b64encode(o).decode('ascii')
+    # orjson把子类交给default，其余的子类按基类编码
+    if isinstance(o, dict):
+        return dict(o)
+    if isinstance(o, str):
+        return str(o)
+    if isinstance(o, int):
+        return int(o)
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(o).__name__))
+
+
+def orjson_dumps(obj):
+    # 子类交给default，Model的id列才能编成字符串；datetime由orjson处理
+    return orjson.dumps(obj, default=default, option=orjson.OPT_PASSTHROUGH_SUBCLASS)
+
+
+_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), default=default)
+
+
+def json_dumps(obj):
+    # json对dict子类不调用default，先换掉Model
+    return _encoder.encode(plain(obj)).encode('utf-8')
+
+
+ENCODERS = dict(json=json_dumps)
+if orjson is not None:
+    ENCODERS['orjson'] = orjson_dumps
+
+dumps = ENCODERS.get('orjson', json_dumps)
+
+
+def use(name='auto'):
+    ' select the encoder behind dumps(), auto picks the fastest installed. '
+    global dumps
+    if name == 'auto':
+        name = 'orjson' if 'orjson' in ENCODERS else 'json'
+    if name not in ENCODERS:
+        raise ValueError('unknown or unavailable json encoder: {}'.format(name))
+    dumps = ENCODERS[name]
+    logging.info('json encoder: {}'.format(name))
+
+
+def register(name, fn):
+    ' add an encoder, fn(obj) must return utf-8 bytes and accept what default() handles. '
+    ENCODERS[name] = fn
+
+
+async def as_async(items):
+    if hasattr(items, '__aiter__'):
+        async for item in items:
+            yield item
+    else:
+        for item in items:
+            yield item
+
+
+async def iter_json(items, ndjson=False, chunk_size=65536):
+    '''
+    Encode an iterator or async iterator as chunks of a JSON array, or of NDJSON lines,
+    of about chunk_size bytes.
+    '''
+    buf, size = ([] if ndjson else [b'[']), 0
+    sep = b'\n' if ndjson else b','
+    first = True
+    async for item in as_async(items):
+        data = dumps(item)
+        if ndjson:
+            buf.append(data)
+            buf.append(sep)
+        else:
+            if not first:
+                buf.append(sep)
+            buf.append(data)
+        first = False
+        size += len(data)
+        # 攒够一块再写，避免每行一次write
+        if size >= chunk_size:
+            yield b''.join(buf)
+            buf, size = [], 0
+    if not ndjson:
+        buf.append(b']')
+    if buf:
+        yield b''.join(buf)
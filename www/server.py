@@ -0,0 +1,162 @@
+'''
+    Pre-forking launcher, run as: python server.py
+
+    Each worker binds configs.server host:port with SO_REUSEPORT so the kernel spreads connections
+    across them; the master restarts workers that die and drains them all on SIGTERM.
+    Every worker has its own entity, counter and page caches, the tables it writes are sent to the
+    others to drop theirs, see peers.py.
+'''
+
+import asyncio, os, signal, socket, shutil, logging, tempfile, time
+
+from config import configs
+
+# 退出太快的worker按该间隔重启，避免崩溃循环占满CPU
+RESTART_DELAY = 1.0
+
+
+def worker_count():
+    return configs.server.workers or os.cpu_count() or 1
+
+
+def pool_size(workers):
+    ' connections per worker pool, so that all workers stay within configs.db.max_connections. '
+    return max(1, min(configs.db.maxsize, configs.db.max_connections // workers))
+
+
+def bind(host, port):
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(1024)
+    sock.setblocking(False)
+    return sock
+
+
+def use_uvloop():
+    if not configs.server.uvloop:
+        return False
+    try:
+        import uvloop
+    except ImportError:
+        return False
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return True
+
+
+def run_worker(maxsize, index, workers, directory):
+    ' body of a forked worker, never returns. '
+    for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGCHLD):
+        signal.signal(sig, signal.SIG_DFL)
+    uvloop = use_uvloop()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    # app在fork之后才导入，日志队列线程和连接池都属于本进程
+    import app
+    import orm
+    import ids
+    from peers import Peers
+    # 每个worker一个id生成器编号，重启的worker沿用原编号
+    ids.use(configs.ids.kind, configs.ids.worker_id + index)
+    peers = Peers(directory, index, workers)
+    peers.start(loop)
+    code = 0
+    try:
+        server = loop.run_until_complete(app.init(loop, bind(configs.server.host, configs.server.port), maxsize))
+        stopping = loop.create_future()
+        loop.add_signal_handler(signal.SIGTERM, lambda: stopping.done() or stopping.set_result(None))
+        loop.add_signal_handler(signal.SIGINT, lambda: stopping.done() or stopping.set_result(None))
+        logging.info('worker {} serving with pool size {}{}'.format(os.getpid(), maxsize,
+                                                                    ', uvloop' if uvloop else ''))
+        loop.run_until_complete(stopping)
+        logging.info('worker {} draining'.format(os.getpid()))
+        loop.run_until_complete(app.shutdown(*server, timeout=configs.server.shutdown_timeout))
+        peers.close(loop)
+    except Exception:
+        logging.exception('worker {} failed'.format(os.getpid()))
+        loop.run_until_complete(orm.destroy_pool())
+        code = 1
+    finally:
+        if app.log_listener is not None:
+            app.log_listener.stop()
+    os._exit(code)
+
+
+def spawn(maxsize, index, workers, directory):
+    pid = os.fork()
+    if pid == 0:
+        try:
+            run_worker(maxsize, index, workers, directory)
+        finally:
+            os._exit(1)
+    return pid
+
+
+def prepare():
+    ' work shared by all workers, done once before forking. '
+    from assets import StaticFiles
+    StaticFiles(encodings=configs.static.encodings, min_size=configs.static.min_size).scan()
+    if configs.templates.production and configs.templates.bytecode_cache:
+        import templating
+        templating.precompile(templating.create_environment(
+            production=True, bytecode_cache=configs.templates.bytecode_cache))
+    if configs.search.enabled and configs.search.path:
+        # 索引只在这里建一次，不是每个worker各建一遍
+        import search
+        search.build_index(configs.search.path)
+
+
+def main():
+    logging.basicConfig(level=configs.log.level)
+    workers = worker_count()
+    maxsize = pool_size(workers)
+    prepare()
+    logging.info('starting {} workers on {}:{}, {} connections each'.format(
+        workers, configs.server.host, configs.server.port, maxsize))
+    # 各worker互相通知写过的表的socket
+    directory = tempfile.mkdtemp(prefix='awesome-peers-')
+    children = {spawn(maxsize, i, workers, directory): (time.monotonic(), i) for i in range(workers)}
+    stopping = []
+
+    def stop(sig, frame):
+        stopping.append(sig)
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    deadline = None
+    while children:
+        if stopping and deadline is None:
+            deadline = time.monotonic() + configs.server.shutdown_timeout + 5
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+        if pid == 0:
+            if deadline is not None and time.monotonic() > deadline:
+                logging.warning('killing {} workers that did not drain'.format(len(children)))
+                for pid in children:
+                    os.kill(pid, signal.SIGKILL)
+                deadline = float('inf')
+            time.sleep(0.1)
+            continue
+        child = children.pop(pid, None)
+        if child is None or stopping:
+            continue
+        started, index = child
+        logging.warning('worker {} exited with status {}, restarting'.format(
+            pid, os.waitstatus_to_exitcode(status)))
+        if time.monotonic() - started < RESTART_DELAY:
+            time.sleep(RESTART_DELAY)
+        children[spawn(maxsize, index, workers, directory)] = (time.monotonic(), index)
+    shutil.rmtree(directory, ignore_errors=True)
+    logging.info('all workers stopped')
+
+
+if __name__ == '__main__':
+    main()
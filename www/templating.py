@@ -0,0 +1,101 @@
+'''
+    Jinja2 environment: production precompilation and the {% cache %} fragment tag.
+'''
+
+import os, time, logging
+from datetime import datetime
+
+from jinja2 import nodes, Environment, FileSystemLoader, FileSystemBytecodeCache
+from jinja2.ext import Extension
+
+from cache import LRUCache
+
+TEMPLATE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+
+
+def datetime_filter(t):
+    delta = int(time.time() - t)
+    if delta < 60:
+        return u'1 minute ago'
+    if delta < 3600:
+        return u'{!s} minutes ago'.format(delta // 60)
+    if delta < 86400:
+        return u'{!s} hours ago'.format(delta // 3600)
+    if delta < 604800:
+        return u'{!s} days ago'.format(delta // 86400)
+    dt = datetime.fromtimestamp(t)
+    return u'{!s}.{!s}.{!s}'.format(dt.year, dt.month, dt.day)
+
+
+# 模板在编译时就检查过滤器是否存在，预编译前必须注册
+FILTERS = dict(datetime=datetime_filter)
+
+
+class FragmentCacheExtension(Extension):
+    '''
+    {% cache 'sidebar', 300 %}...{% endcache %} renders the body once per key and keeps it for
+    ttl seconds. Extra arguments after the ttl are part of the key, e.g. {% cache 'user', 60, user.id %}.
+    '''
+    tags = {'cache'}
+
+    def __init__(self, environment):
+        super(FragmentCacheExtension, self).__init__(environment)
+        environment.extend(fragment_cache=LRUCache(size=1000))
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        if len(args) < 2:
+            args.append(nodes.Const(None))
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_cache', [nodes.List(args)]), [], [], body).set_lineno(lineno)
+
+    def _cache(self, args, caller):
+        name, ttl = args[0], args[1]
+        key = (name,) + tuple(args[2:])
+        cache = self.environment.fragment_cache
+        value = cache.get(key)
+        if value is None:
+            value = caller()
+            cache.put(key, value, ttl)
+        return value
+
+
+def create_environment(path=None, production=False, bytecode_cache=None, fragment_cache_size=1000, filters=FILTERS,
+                       **options):
+    '''
+    Jinja2 environment for path. In production templates are not checked for changes, all of them
+    are compiled up front, and compiled code is shared through bytecode_cache, a directory.
+    '''
+    if path is None:
+        path = TEMPLATE_PATH
+    if production:
+        options.update(auto_reload=False, cache_size=-1)
+        if bytecode_cache:
+            os.makedirs(bytecode_cache, exist_ok=True)
+            options['bytecode_cache'] = FileSystemBytecodeCache(bytecode_cache)
+    env = Environment(loader=FileSystemLoader(path), extensions=[FragmentCacheExtension], **options)
+    env.fragment_cache.size = fragment_cache_size
+    env.filters.update(filters)
+    # 由coroweb.add_static替换为带内容哈希的版本
+    env.globals['static_url'] = lambda name: '/static/' + name
+    return env
+
+
+def precompile(env):
+    ' load every template so that renders never compile, returns the number of templates. '
+    names = env.list_templates(filter_func=lambda name: not name.startswith('.'))
+    for name in names:
+        env.get_template(name)
+    logging.info('precompiled {} templates'.format(len(names)))
+    return len(names)
+
+
+if __name__ == '__main__':
+    # 预先把模板编译进字节码缓存目录，供各worker启动时直接加载
+    from config import configs
+
+    logging.basicConfig(level=logging.INFO)
+    precompile(create_environment(production=True, bytecode_cache=configs.templates.bytecode_cache))
@@ -0,0 +1,32 @@
+import asyncio, unittest
+from typing import List
+
+from aiohttp.test_utils import make_mocked_request
+
+from coroweb import ArgumentBinder
+
+
+def bind(fn, path):
+    return asyncio.run(ArgumentBinder(fn).bind(make_mocked_request('GET', path)))
+
+
+class ListArgumentTest(unittest.TestCase):
+
+    def test_missing_optional_list_keeps_default(self):
+        async def handler(*, q, tags: List[int] = ()):
+            pass
+        self.assertEqual(bind(handler, '/?q=a'), {'q': 'a'})
+
+    def test_missing_required_list_is_bad_request(self):
+        async def handler(*, tags: list):
+            pass
+        self.assertEqual(bind(handler, '/?q=a').status, 400)
+
+    def test_list_values(self):
+        async def handler(*, tags: List[int] = ()):
+            pass
+        self.assertEqual(bind(handler, '/?tags=1&tags=2'), {'tags': [1, 2]})
+
+
+if __name__ == '__main__':
+    unittest.main()